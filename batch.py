@@ -0,0 +1,441 @@
+import os
+import json
+import shutil
+import argparse
+from functools import partial
+from collections import Counter
+from pathlib import Path
+from typing import Hashable
+
+import cv2
+import numpy as np
+
+from modules import (
+    ROIExtractor,
+    HomographyAligner,
+    AlignedPage,
+    CheckboxDetector,
+    EncirclementDetector,
+    ChoiceResolver,
+    ChoiceResult,
+    MarkClassifier,
+    TextRecognizer,
+    PageAnalysis,
+    CompiledTemplate,
+    TemplateRegistry,
+    RegionType,
+    calibrate_template,
+)
+from modules.template_validation import REGION_TYPES, CHOICE_SEPARATOR
+from modules.config import (
+    ACCEPTED_FILE_TYPES,
+    DATA_FOLDER,
+    MODELS_FOLDER,
+    QUARANTINE_FOLDER,
+)
+
+# Region types that a mark classifier can be trained for
+MARK_TYPES = (RegionType.CHECKBOX, RegionType.ENCIRCLEMENT)
+
+
+class BatchRunner:
+    """Headless processing of scanned forms into JSON files."""
+    def __init__(self, models_folder: str = MODELS_FOLDER):
+        aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_1000)
+        parameters = cv2.aruco.DetectorParameters()
+        detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
+
+        self.roi_extractor = ROIExtractor(detector)
+        self.homography_aligner = HomographyAligner(
+            detector, pyramid_levels=1, ransac_threshold=3.0, reuse_matrix=True)
+        self.checkbox_detector = CheckboxDetector()
+        self.encirclement_detector = EncirclementDetector()
+        self.text_recognizer = TextRecognizer()
+        self.choice_resolver = ChoiceResolver(self.checkbox_detector, self.encirclement_detector)
+        # Templates are calibrated on their blank form
+        self.template_registry = TemplateRegistry(calibrate=partial(
+            calibrate_template,
+            homography_aligner=self.homography_aligner,
+            roi_extractor=self.roi_extractor,
+            checkbox_detector=self.checkbox_detector))
+
+        # Decisions with a lower confidence are listed for a manual review
+        self.review_threshold = 0.2
+        # Largest skew in degrees and aspect ratio deviation of an accepted
+        # alignment, None accepts any page shape
+        self.max_skew: float | None = None
+        self.max_aspect_deviation: float | None = None
+
+        # Learned classifiers replace the detectors of their region type
+        # once a model is trained with train_marks.py
+        self.mark_classifiers: dict[RegionType, MarkClassifier] = {}
+        for region_type in MARK_TYPES:
+            path = os.path.join(models_folder, f'{region_type.value}.npz')
+            if os.path.exists(path):
+                self.mark_classifiers[region_type] = MarkClassifier.load(path)
+
+        # Number of accepted, rejected and failed scans, and of accepted
+        # scans with decisions to review
+        self.counters = Counter()
+
+    def process_image(
+            self,
+            image_path: str,
+            compiled: CompiledTemplate,
+            key: Hashable = None,
+            ) -> dict[str, str | bool | dict]:
+        """
+        Extract the data of a single scanned form.
+
+        The alignment metrics are added under the `_alignment` key. If the
+        alignment is rejected, no region is processed. The regions and
+        choice groups whose confidence is below `review_threshold` are
+        listed under the `_review` key.
+
+        Args:
+            image_path: Path to the scanned image
+            compiled: Compiled template of the form
+            key: Scanner/template key of the remembered alignment
+
+        Returns:
+            dict: Extracted value of every region, keyed by region name,
+            the value of every choice group, the decisions to review and the
+            alignment metrics
+        """
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f'Could not read image {image_path}')
+
+        alignment, page, region_coordinates = self.align_image(image, compiled, key)
+        if page is None:
+            return {'_alignment': alignment}
+
+        data = {}
+        review = []
+        if len(region_coordinates):
+            # Only the part of the page covered by the regions is warped, and
+            # binarized once for all the region detectors
+            x1, y1, x2, y2 = page.clip(
+                *region_coordinates[:, :2].min(axis=0).tolist(), *region_coordinates[:, 2:].max(axis=0).tolist())
+            area = page.crop(x1, y1, x2, y2)
+            reference = None if compiled.reference_ink is None else compiled.reference_ink[y1:y2, x1:x2]
+            analysis = PageAnalysis(area, reference)
+            # Region coordinates on the analysis
+            rects = region_coordinates - [x1, y1, x1, y1]
+            data, review = self.process_regions(compiled, area, analysis, rects)
+
+        data['_review'] = review
+        data['_alignment'] = alignment
+
+        return data
+
+    def process_regions(
+            self,
+            compiled: CompiledTemplate,
+            area: np.ndarray,
+            analysis: PageAnalysis,
+            rects: np.ndarray,
+            ) -> tuple[dict[str, str | bool | dict], list[str]]:
+        """
+        Extract the values of the regions of a page.
+
+        Args:
+            compiled: Compiled template of the form
+            area: Aligned part of the page covered by the regions
+            analysis: Analysis of `area`
+            rects: (R, 4) region coordinates on `area`
+
+        Returns:
+            tuple: Value of every region and choice group, and the names of
+            the decisions to review
+        """
+        def crop(rect):
+            x1, y1, x2, y2 = analysis.clip(*rect)
+            return area[y1:y2, x1:x2]
+
+        # The marks of all the regions of a classified type at once
+        probabilities: dict[int, float] = {}
+        for region_type, classifier in self.mark_classifiers.items():
+            indices = compiled.groups[region_type]
+            if indices.size:
+                crops = [crop(rect) for rect in rects[indices].tolist()]
+                probabilities.update(zip(indices.tolist(), classifier.predict_proba(crops).tolist()))
+
+        # The options of a choice group are decided together
+        choices = {}
+        chosen: dict[int, bool] = {}
+        review = []
+        for title, indices in compiled.choice_groups.items():
+            group_probabilities = None
+            if indices[0] in probabilities:
+                group_probabilities = [probabilities[i] for i in indices.tolist()]
+            result = self.process_choice_group(
+                analysis, compiled, title, indices, rects[indices], group_probabilities)
+            choices[title] = {
+                'value': result.value,
+                'confidence': result.confidence,
+                'ambiguous': result.ambiguous,
+            }
+            chosen.update(zip(indices.tolist(), result.marked.tolist()))
+            if result.ambiguous or result.confidence < self.review_threshold:
+                review.append(title)
+
+        # Score all the other checkboxes of the page at once
+        checkbox_indices = compiled.groups[RegionType.CHECKBOX]
+        checkbox_indices = checkbox_indices[~np.isin(checkbox_indices, [*chosen, *probabilities])]
+        inner_rects = None if compiled.inner_rects is None else compiled.inner_rects[checkbox_indices]
+        scores = self.checkbox_detector.score(analysis, rects[checkbox_indices], inner_rects)
+        checkboxes = dict(zip(
+            checkbox_indices.tolist(), zip(scores.checked.tolist(), scores.confidence.tolist())))
+
+        data = {}
+        for i, (name, code, coordinates) in enumerate(zip(
+                compiled.names, compiled.types.tolist(), rects.tolist())):
+            if i in chosen:
+                data[name] = chosen[i]
+                continue
+            if i in probabilities:
+                data[name] = probabilities[i] > 0.5
+                confidence = abs(probabilities[i] - 0.5) * 2
+            elif i in checkboxes:
+                data[name], confidence = checkboxes[i]
+            else:
+                data[name], confidence = self.process_region(
+                    analysis, REGION_TYPES[code], coordinates, crop(coordinates))
+            if confidence is not None and confidence < self.review_threshold:
+                review.append(name)
+
+        if choices:
+            data['_choices'] = choices
+
+        return data, review
+
+    def align_image(
+            self,
+            image: np.ndarray,
+            compiled: CompiledTemplate,
+            key: Hashable = None,
+            ) -> tuple[dict, AlignedPage | None, np.ndarray | None]:
+        """
+        Align a scan to its template and locate the regions.
+
+        The data extraction preprocessing of the template is applied to the
+        aligned page, so the regions read from it are the ones the detectors
+        and the mark classifiers see.
+
+        Args:
+            image: Scanned image
+            compiled: Compiled template of the form
+            key: Scanner/template key of the remembered alignment
+
+        Returns:
+            tuple: Alignment metrics, the aligned page and the (R, 4) region
+            coordinates, both None if the alignment is rejected
+        """
+        template = compiled.template
+        length = template.length
+        width = template.width
+
+        marker_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if compiled.preprocessing is not None:
+            marker_image = compiled.preprocessing.apply_homography_preprocessing(marker_image)
+        try:
+            matrix, markers = self.homography_aligner.find_homography(
+                marker_image, length, width,
+                key=key,
+                search_corners=template.use_coordinates and not template.marker_positions,
+                marker_positions=template.marker_positions,
+                marker_size=template.marker_size)
+        except ValueError as e:
+            # Missing or inconsistent markers
+            return {'rejected': True, 'reason': str(e)}, None, None
+
+        quality = self.homography_aligner.assess(
+            matrix, markers, length, width,
+            marker_positions=template.marker_positions,
+            marker_size=template.marker_size,
+            max_skew=self.max_skew,
+            max_aspect_deviation=self.max_aspect_deviation)
+
+        if quality.rejected:
+            return quality._asdict(), None, None
+
+        # Regions are warped one by one, the full page is only needed if a
+        # marker has to be detected again on the aligned page or the
+        # template has data extraction preprocessing
+        page = AlignedPage(image, matrix, length, width)
+
+        if template.use_coordinates:
+            region_coordinates = compiled.rects
+        else:
+            locations = self.roi_extractor.map_markers(matrix, markers)
+            if not np.isin(compiled.marker_ids, locations.ids).all():
+                locations = self.roi_extractor.get_marker_locations(
+                    page.warp(), matrix, markers, compiled.marker_ids)
+            region_coordinates = self.roi_extractor.regions_to_coordinates(
+                compiled, locations)
+
+        preprocessing = compiled.preprocessing
+        if preprocessing is not None and preprocessing.has_data_extraction_steps:
+            # Only the regions are denoised, the marks in grayscale
+            page = page.replace_aligned(preprocessing.apply_data_extraction_preprocessing(
+                page.warp(), region_coordinates, compiled.types != REGION_TYPES.index(RegionType.TEXT)))
+
+        return quality._asdict(), page, region_coordinates
+
+    def process_choice_group(
+            self,
+            page: PageAnalysis,
+            compiled: CompiledTemplate,
+            title: str,
+            indices: np.ndarray,
+            rects: np.ndarray,
+            probabilities: list[float] = None,
+            ) -> ChoiceResult:
+        """
+        Decide the value of a choice group from the scores of its options.
+
+        Args:
+            page: Analysis of the aligned regions
+            compiled: Compiled template of the form
+            title: Title of the group
+            indices: Region indices of the options
+            rects: (K, 4) option regions on `page`
+            probabilities: Mark classifier probabilities of the options,
+                the options are scored on `page` if not given
+
+        Returns:
+            ChoiceResult: Value of the group and its confidence
+        """
+        labels = [compiled.names[i].partition(CHOICE_SEPARATOR)[2] for i in indices.tolist()]
+        multiple = title in compiled.template.multi_choice
+
+        if probabilities is not None:
+            # Already scored by a mark classifier
+            return self.choice_resolver.resolve(labels, probabilities, 0.5, multiple)
+
+        inner_rects = None if compiled.inner_rects is None else compiled.inner_rects[indices]
+
+        return self.choice_resolver.resolve_group(
+            page, labels, rects, REGION_TYPES[compiled.types[indices[0]]], inner_rects, multiple)
+
+    def process_region(
+            self,
+            analysis: PageAnalysis,
+            region_type: str,
+            coordinates: list[int],
+            cropped_region: np.ndarray,
+            ) -> tuple[str | bool, float | None]:
+        """
+        Extract the value of a single encirclement or text region.
+
+        The checkboxes of a page are scored all at once in `process_regions`.
+
+        Args:
+            analysis: Analysis of the aligned regions
+            region_type: Type of the region
+            coordinates: Region coordinates on `analysis`
+            cropped_region: Aligned image of the region
+
+        Returns:
+            tuple: Value of the region and the confidence of the decision
+            from 0 to 1, None for text regions
+        """
+        if region_type == RegionType.ENCIRCLEMENT:
+            score = self.encirclement_detector.score(
+                analysis.gray_roi(*coordinates), page=analysis, coordinates=coordinates)
+            return score.has_circle, score.confidence
+        elif region_type == RegionType.TEXT:
+            text = self.text_recognizer.recognize_text(
+                cropped_region, page=analysis, coordinates=coordinates)
+            return text, None
+        else:
+            # This should not happen because the template is validated
+            raise ValueError(f'Invalid region type: {region_type}')
+
+    def run(
+            self,
+            image_paths: list[str],
+            template_path: str,
+            output_folder: str = DATA_FOLDER,
+            key: Hashable = None,
+            quarantine_folder: str = QUARANTINE_FOLDER,
+            ) -> None:
+        os.makedirs(output_folder, exist_ok=True)
+
+        self.template_registry.load(template_path)
+
+        for image_path in image_paths:
+            try:
+                # Latest valid version, swapped in by the registry when the file changes
+                compiled = self.template_registry.get(template_path)
+                data = self.process_image(image_path, compiled, key)
+            except Exception as e:
+                self.counters['failed'] += 1
+                print(f'Error processing {image_path}, skipped: {e}')
+                continue
+
+            filename = os.path.splitext(os.path.basename(image_path))[0]
+
+            if data['_alignment']['rejected']:
+                # Set the scan aside with its metrics for a re-scan
+                self.counters['rejected'] += 1
+                os.makedirs(quarantine_folder, exist_ok=True)
+                shutil.copy2(image_path, quarantine_folder)
+                save_path = os.path.join(quarantine_folder, f'{filename}.json')
+                print(f'{image_path} rejected: {data["_alignment"]["reason"]}')
+            else:
+                self.counters['accepted'] += 1
+                save_path = os.path.join(output_folder, f'{filename}.json')
+                print(f'{image_path} -> {save_path}')
+                if data['_review']:
+                    self.counters['review'] += 1
+                    print(f'{image_path} needs a review of: {", ".join(data["_review"])}')
+
+            with open(save_path, 'w') as file:
+                json.dump(data, file, indent=4)
+
+        print(' '.join(f'{name}: {self.counters[name]}' for name in ['accepted', 'review', 'rejected', 'failed']))
+
+
+def find_images(paths: list[str]) -> list[str]:
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(Path(path).iterdir())
+        else:
+            files = [Path(path)]
+        for file in files:
+            if file.suffix.lower() in ACCEPTED_FILE_TYPES:
+                image_paths.append(str(file))
+    return image_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract the data of scanned forms without the GUI.')
+    parser.add_argument('images', nargs='+', help='Scanned images or folders of scanned images')
+    parser.add_argument('-t', '--template', required=True, help='Template YAML file')
+    parser.add_argument('-o', '--output', default=DATA_FOLDER, help='Output folder of the JSON files')
+    parser.add_argument('-q', '--quarantine', default=QUARANTINE_FOLDER, help='Folder of the scans with a rejected alignment')
+    parser.add_argument('-m', '--models', default=MODELS_FOLDER, help='Folder of the mark classifiers trained with train_marks.py')
+    parser.add_argument('-s', '--scanner', help='Scanner profile, scans of the same profile and template reuse their alignment')
+    parser.add_argument('--max-skew', type=float, help='Reject the scans whose page corners deviate more degrees from a right angle')
+    parser.add_argument('--max-aspect-deviation', type=float, help='Reject the scans whose aspect ratio deviates more from the template, e.g. 0.1')
+    args = parser.parse_args()
+
+    runner = BatchRunner(args.models)
+    # Alignments are only remembered for a scanner profile
+    key = None if args.scanner is None else (args.template, args.scanner)
+    runner.max_skew = args.max_skew
+    runner.max_aspect_deviation = args.max_aspect_deviation
+    # Pick up edits of the template while the scans are processed
+    runner.template_registry.load(args.template)
+    runner.template_registry.watch()
+    try:
+        runner.run(find_images(args.images), args.template, args.output, key=key, quarantine_folder=args.quarantine)
+    finally:
+        runner.template_registry.stop()
+
+
+if __name__ == '__main__':
+    main()
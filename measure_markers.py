@@ -0,0 +1,45 @@
+import argparse
+
+import cv2
+import yaml
+
+from modules import HomographyAligner, PreprocessingPipeline, validate_template_file
+from modules.template_validation import convert_template_to_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the marker positions and sizes of a template on a scan of its blank form.')
+    parser.add_argument('template', help='Template YAML file, updated in place')
+    parser.add_argument('-r', '--reference', help='Clean scan of the form, the reference_image of the template by default')
+    args = parser.parse_args()
+
+    template = validate_template_file(args.template)
+    reference = args.reference or template.reference_image
+    if not reference:
+        parser.error('The template has no reference_image, pass a scan with -r')
+
+    image = cv2.imread(reference, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        parser.error(f'Could not read image {reference}')
+    if template.preprocessing is not None:
+        image = PreprocessingPipeline(template.preprocessing).apply_homography_preprocessing(image)
+
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_1000)
+    detector = cv2.aruco.ArucoDetector(aruco_dict, cv2.aruco.DetectorParameters())
+    homography_aligner = HomographyAligner(detector)
+
+    positions, marker_size = homography_aligner.measure_marker_positions(
+        image, template.length, template.width)
+    template.marker_positions = positions
+    template.marker_size = marker_size
+
+    with open(args.template, 'w') as file:
+        yaml.dump(convert_template_to_dict(template), file, sort_keys=False)
+
+    print(f'{args.template}: corner markers {marker_size} px, {len(positions)} other markers')
+    for id_, (x, y, size) in sorted(positions.items()):
+        print(f'  {id_}: [{x}, {y}] {size} px')
+
+
+if __name__ == '__main__':
+    main()
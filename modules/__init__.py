@@ -1,20 +1,41 @@
-from .roi_extraction.roi_extractor import ROIExtractor
-from .homography_alignment.homography_aligner import HomographyAligner
+from .roi_extraction.roi_extractor import ROIExtractor, MarkerLocations
+from .homography_alignment.homography_aligner import HomographyAligner, AlignmentQuality
+from .homography_alignment.aligned_page import AlignedPage
 from .checkbox_detection.checkbox_detector import CheckboxDetector
 from .encirclement_detection.encirclement_detector import EncirclementDetector
+from .choice_resolution.choice_resolver import ChoiceResolver, ChoiceResult
+from .mark_classification.mark_classifier import MarkClassifier
 from .text_recognition.text_recognizer import TextRecognizer
+from .page_analysis.page_analysis import PageAnalysis
+from .preprocessing.preprocessing_pipeline import PreprocessingConfig, PreprocessingPipeline
 from .template_validation import (
-    validate_template_file, Template, Region, RegionType
+    validate_template_file, Template, Region, RegionType,
+    CompiledTemplate, compile_template,
 )
+from .template_registry import TemplateRegistry
+from .template_calibration import calibrate_template
 
 __all__ = [
     'ROIExtractor',
+    'MarkerLocations',
     'HomographyAligner',
+    'AlignmentQuality',
+    'AlignedPage',
     'CheckboxDetector',
     'EncirclementDetector',
+    'ChoiceResolver',
+    'ChoiceResult',
+    'MarkClassifier',
     'TextRecognizer',
+    'PageAnalysis',
+    'PreprocessingConfig',
+    'PreprocessingPipeline',
     'validate_template_file',
     'Template',
     'Region',
     'RegionType',
+    'CompiledTemplate',
+    'compile_template',
+    'TemplateRegistry',
+    'calibrate_template',
 ]
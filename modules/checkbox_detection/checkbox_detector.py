@@ -1,20 +1,183 @@
+from typing import NamedTuple
+
 import cv2
+import numpy as np
+
+from ..page_analysis.page_analysis import PageAnalysis
+
+
+class CheckboxScores(NamedTuple):
+    # Scores from 0 to 1, 0.5 at the decision threshold, (N,)
+    score: np.ndarray
+    # True for the checked boxes, (N,)
+    checked: np.ndarray
+    # Ink ratio inside the box, NaN where the added ink decided, (N,)
+    fill_ratio: np.ndarray
+    # Added ink ratio of the region, NaN without a blank reference, (N,)
+    added_ratio: np.ndarray
+
+    @property
+    def confidence(self) -> np.ndarray:
+        """Distance of the scores to the threshold, from 0 to 1."""
+        return np.abs(self.score - 0.5) * 2
 
 
 class CheckboxDetector:
-    def __init__(self, lr_indent=0.20, tb_indent=0.20, pixel_threshold=0.85):
+    def __init__(self, lr_indent=0.20, tb_indent=0.20, pixel_threshold=0.85, reference_range=(0.002, 0.02)):
         self.lr_indent = lr_indent
         self.tb_indent = tb_indent
         self.pixel_threshold = pixel_threshold
+        # Added ink ratios below/above which a region is decided without
+        # looking at the box, used when the page has a blank reference
+        self.reference_range = reference_range
 
-    def detect(self, img_gray) -> bool:
-        contours_list = self.find_all_contours(img_gray)
-        largest_contour = self.get_largest_contour(contours_list)
+    def detect(
+            self,
+            img_gray,
+            page: PageAnalysis = None,
+            coordinates: list[int] = None) -> bool:
+        if page is not None:
+            return self.detect_on_page(page, coordinates)
+
+        # Binarize once for both the outline and the fill
         img_binary = self.binarize_image(img_gray)
+        contours_list = self.find_contours(img_binary)
+        largest_contour = self.get_largest_contour(contours_list)
 
         cropped_img = self.crop_contour(img_binary, largest_contour)
         return self.contains_black_pixels(cropped_img)
 
+    def detect_on_page(self, page: PageAnalysis, coordinates: list[int]) -> bool:
+        return bool(self.detect_many(page, [coordinates])[0])
+
+    def detect_many(
+            self,
+            page: PageAnalysis,
+            rects: np.ndarray,
+            inner_rects: np.ndarray = None) -> np.ndarray:
+        """
+        Detect the checked boxes among all the checkbox regions of a page.
+
+        The page binarization is reused: the box outline is the largest
+        external ink component of each region, and the fill ratios of all
+        the boxes are read from the integral image in one pass. With
+        calibrated inner rectangles the outline search is skipped. If the
+        page has a blank reference, only the regions whose added ink is
+        ambiguous are looked at.
+
+        Args:
+            page: Analysis of the aligned page
+            rects: (N, 4) checkbox regions [x1, y1, x2, y2]
+            inner_rects: (N, 4) inner rectangles relative to the region
+                top-left corner, from `calibrate`
+
+        Returns:
+            np.ndarray: (N,) True for the checked boxes
+        """
+        return self.score(page, rects, inner_rects).checked
+
+    def score(
+            self,
+            page: PageAnalysis,
+            rects: np.ndarray,
+            inner_rects: np.ndarray = None) -> CheckboxScores:
+        """
+        Score all the checkbox regions of a page, see `detect_many`.
+
+        The score is the fill ratio scaled so that the threshold
+        (1 - pixel_threshold) maps to 0.5. Regions decided by their added
+        ink score by how far the added ink ratio is past the decision bound.
+
+        Args:
+            page: Analysis of the aligned page
+            rects: (N, 4) checkbox regions [x1, y1, x2, y2]
+            inner_rects: (N, 4) inner rectangles relative to the region
+                top-left corner, from `calibrate`
+
+        Returns:
+            CheckboxScores: Scores, decisions and ratios of the boxes
+        """
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+        if inner_rects is not None:
+            inner_rects = np.asarray(inner_rects, dtype=int).reshape(-1, 4)
+
+        count = len(rects)
+        fill_ratios = np.full(count, np.nan)
+        added_ratios = np.full(count, np.nan)
+        unsure = np.ones(count, dtype=bool)
+        checked = np.zeros(count, dtype=bool)
+        scores = np.zeros(count)
+
+        if page.has_reference:
+            low, high = self.reference_range
+            added_ratios = page.added_ratios(rects)
+            checked = added_ratios >= high
+            empty = added_ratios <= low
+            scores[checked] = 0.5 + 0.5 * np.clip(added_ratios[checked] / high - 1, 0, 1)
+            scores[empty] = 0.5 - 0.5 * np.clip(1 - added_ratios[empty] / low, 0, 1)
+            unsure = ~checked & ~empty
+
+        if unsure.any():
+            fill_ratios[unsure] = self.fill_ratios(
+                page, rects[unsure], None if inner_rects is None else inner_rects[unsure])
+            checked[unsure] = 1 - fill_ratios[unsure] < self.pixel_threshold
+            threshold = 1 - self.pixel_threshold
+            scores[unsure] = np.clip(fill_ratios[unsure] / (2 * threshold), 0, 1)
+
+        return CheckboxScores(
+            score=scores,
+            checked=checked,
+            fill_ratio=fill_ratios,
+            added_ratio=added_ratios,
+        )
+
+    def fill_ratios(
+            self,
+            page: PageAnalysis,
+            rects: np.ndarray,
+            inner_rects: np.ndarray = None) -> np.ndarray:
+        """Ink ratio inside the box of each of the (N, 4) regions."""
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+        if inner_rects is not None:
+            origins = np.tile(rects[:, :2], 2)
+            return page.ink_ratios(origins + np.asarray(inner_rects, dtype=int).reshape(-1, 4))
+
+        rects = page.clip_many(rects)
+        boxes = np.array([self.find_box(page, *rect) for rect in rects.tolist()], dtype=int).reshape(-1, 4)
+        return page.ink_ratios(self.inner_rects(boxes))
+
+    def calibrate(self, page: PageAnalysis, rects: np.ndarray) -> np.ndarray:
+        """
+        Learn the inner rectangle of every checkbox from a blank form.
+
+        Args:
+            page: Analysis of the aligned blank form
+            rects: (N, 4) checkbox regions [x1, y1, x2, y2]
+
+        Returns:
+            np.ndarray: (N, 4) inner rectangles relative to the region
+            top-left corner
+        """
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+        clipped = page.clip_many(rects)
+        boxes = np.array([self.find_box(page, *rect) for rect in clipped.tolist()], dtype=int).reshape(-1, 4)
+        return self.inner_rects(boxes) - np.tile(rects[:, :2], 2)
+
+    def find_box(self, page: PageAnalysis, x1: int, y1: int, x2: int, y2: int) -> tuple[int, int, int, int]:
+        """Bounding rect (x, y, w, h) of the largest ink component of a region, in page coordinates."""
+        if x2 <= x1 or y2 <= y1:
+            return x1, y1, 0, 0
+
+        contours, _ = cv2.findContours(
+            page.ink_roi(x1, y1, x2, y2), mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            # No outline, the region is the box
+            return x1, y1, x2 - x1, y2 - y1
+
+        rects = np.array([cv2.boundingRect(contour) for contour in contours])
+        x, y, w, h = rects[np.argmax(rects[:, 2] * rects[:, 3])]
+        return x1 + x, y1 + y, w, h
+
     def contains_black_pixels(self, img_binary):
         area = img_binary.shape[0] * img_binary.shape[1]
         pixel_percentage = cv2.countNonZero(img_binary) / area
@@ -26,6 +189,9 @@ class CheckboxDetector:
 
     def find_all_contours(self, img_gray):
         img_binary = self.binarize_image(img_gray)
+        return self.find_contours(img_binary)
+
+    def find_contours(self, img_binary):
         img_blur = cv2.GaussianBlur(img_binary, (3, 3), sigmaX=0, sigmaY=0)
         edges = cv2.Canny(image=img_blur, threshold1=100, threshold2=200)
         contours, _ = cv2.findContours(
@@ -44,7 +210,17 @@ class CheckboxDetector:
                 largest_contour = contour
         return largest_contour
 
-    def crop_contour(self, img_binary, contour):
+    def inner_rects(self, boxes: np.ndarray) -> np.ndarray:
+        """Vectorized `inner_rect` of (N, 4) boxes [x, y, w, h]."""
+        x, y, w, h = boxes.T
+        return np.stack([
+            (x + w * self.tb_indent).astype(int),
+            (y + h * self.lr_indent).astype(int),
+            (x + w * (1 - self.tb_indent)).astype(int),
+            (y + h * (1 - self.lr_indent)).astype(int),
+        ], axis=1)
+
+    def inner_rect(self, contour):
         x, y, w, h = cv2.boundingRect(contour)
 
         tl_y = int(y + h * self.lr_indent)
@@ -52,4 +228,8 @@ class CheckboxDetector:
         tl_x = int(x + w * self.tb_indent)
         br_x = int(x + w * (1 - self.tb_indent))
 
+        return tl_x, tl_y, br_x, br_y
+
+    def crop_contour(self, img_binary, contour):
+        tl_x, tl_y, br_x, br_y = self.inner_rect(contour)
         return img_binary[tl_y:br_y, tl_x:br_x]
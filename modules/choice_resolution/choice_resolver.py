@@ -0,0 +1,132 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from ..checkbox_detection.checkbox_detector import CheckboxDetector
+from ..encirclement_detection.encirclement_detector import EncirclementDetector
+from ..page_analysis.page_analysis import PageAnalysis
+from ..template_validation import RegionType
+
+
+class ChoiceResult(NamedTuple):
+    # Label of the chosen option, None if no option is marked, or the
+    # labels of all the marked options of a multiple choice group
+    value: str | list[str] | None
+    # Score margin of the decision, from 0 to 1
+    confidence: float
+    # True if the margin is too small to trust the decision
+    ambiguous: bool
+    # True for the marked options, (K,)
+    marked: np.ndarray
+    # Normalized option scores, 0.5 at the detector threshold, (K,)
+    scores: np.ndarray
+
+
+class ChoiceResolver:
+    """
+    Resolve the options of a "Title = Choice" group into a single value.
+
+    All the options of a group are scored in one pass and compared with
+    each other instead of being decided one by one, so a form where the
+    printed text of one option looks like a mark still has one choice.
+    """
+    def __init__(
+            self,
+            checkbox_detector: CheckboxDetector,
+            encirclement_detector: EncirclementDetector,
+            margin: float = 0.2):
+        self.checkbox_detector = checkbox_detector
+        self.encirclement_detector = encirclement_detector
+        self.margin = margin
+
+    def resolve_group(
+            self,
+            page: PageAnalysis,
+            labels: list[str],
+            rects: np.ndarray,
+            region_type: RegionType,
+            inner_rects: np.ndarray = None,
+            multiple: bool = False) -> ChoiceResult:
+        """
+        Score the options of a group on a page and pick the marked one(s).
+
+        Checkboxes are scored by `CheckboxDetector.score`. Encircled options
+        are scored by their added ink if the page has a blank reference, and
+        `EncirclementDetector.score` of every option only runs if that leaves
+        no clear winner.
+
+        Args:
+            page: Analysis of the aligned page
+            labels: Option labels, e.g. ["Male", "Female"]
+            rects: (K, 4) option regions [x1, y1, x2, y2]
+            region_type: Type of the option regions
+            inner_rects: (K, 4) calibrated checkbox inner rectangles
+            multiple: Several options may be marked
+
+        Returns:
+            ChoiceResult: Value of the group and its confidence
+        """
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+
+        if region_type == RegionType.CHECKBOX:
+            scores = self.checkbox_detector.score(page, rects, inner_rects).score
+            return self.resolve(labels, scores, 0.5, multiple)
+
+        if page.has_reference:
+            result = self.resolve(
+                labels, page.added_ratios(rects), self.encirclement_detector.reference_range[1], multiple)
+            if not result.ambiguous:
+                return result
+
+        scores = [
+            self.encirclement_detector.score(None, page=page, coordinates=rect).score
+            for rect in rects.tolist()]
+        return self.resolve(labels, scores, 0.5, multiple)
+
+    def resolve(
+            self,
+            labels: list[str],
+            scores: np.ndarray,
+            threshold: float,
+            multiple: bool = False) -> ChoiceResult:
+        """
+        Pick the marked option(s) from their scores.
+
+        The scores are normalized so that the threshold maps to 0.5. In an
+        exclusive group, "no choice" competes as an extra option scoring
+        0.5, and the confidence is twice the margin between the winner and
+        the runner-up. In a multiple choice group every option is decided
+        on its own, and the confidence is twice the smallest margin to 0.5.
+
+        Args:
+            labels: Option labels
+            scores: (K,) raw option scores, higher means marked
+            threshold: Score above which an option is marked
+            multiple: Several options may be marked
+
+        Returns:
+            ChoiceResult: Value of the group and its confidence
+        """
+        scores = np.clip(np.asarray(scores, dtype=np.float64) / (2 * threshold), 0, 1)
+
+        if multiple:
+            marked = scores > 0.5
+            confidence = float(np.abs(scores - 0.5).min(initial=0.5)) * 2
+            value = [label for label, is_marked in zip(labels, marked.tolist()) if is_marked]
+        else:
+            candidates = np.append(scores, 0.5)
+            order = np.argsort(-candidates, kind='stable')
+            confidence = float(candidates[order[0]] - candidates[order[1]]) * 2
+            marked = np.zeros(len(scores), dtype=bool)
+            value = None
+            if order[0] < len(scores):
+                marked[order[0]] = True
+                value = labels[order[0]]
+
+        return ChoiceResult(
+            value=value,
+            confidence=confidence,
+            ambiguous=confidence < self.margin,
+            marked=marked,
+            scores=scores,
+        )
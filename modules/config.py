@@ -3,4 +3,6 @@ ACCEPTED_FILE_TYPES = ['.jpg', '.jpeg', '.png']
 TEMPLATES_FOLDER = './templates'
 SCANNED_FOLDER = './scanned'
 DATA_FOLDER = './data'
+QUARANTINE_FOLDER = './quarantine'
 ROI_MIME_TYPE = 'application/x-roi-rectangle'
+MODELS_FOLDER = './models'
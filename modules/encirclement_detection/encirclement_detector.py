@@ -1,26 +1,105 @@
+import time
+from typing import NamedTuple
+
 import cv2
 import numpy as np
 
+from ..page_analysis.page_analysis import PageAnalysis
+
+
+class EncirclementScore(NamedTuple):
+    # True if the region is encircled
+    has_circle: bool
+    # Score from 0 to 1, 0.5 at the decision threshold
+    score: float
+    # Area of the largest circular contour over the region area, NaN if none
+    area_ratio: float = np.nan
+    # Circularity of the scored contour minus its threshold, NaN if none
+    shape_margin: float = np.nan
+    # Added ink ratio of the region, NaN without a blank reference
+    added_ratio: float = np.nan
+
+    @property
+    def confidence(self) -> float:
+        """Distance of the score to the threshold, from 0 to 1."""
+        return abs(self.score - 0.5) * 2
+
 
 class EncirclementDetector:
-    def detect(self, img_gray, min_area=0.15, max_area=0.9) -> bool:
+    def __init__(self, reference_range=(0.002, 0.05)):
+        # Added ink ratios below/above which a region is decided without
+        # looking for a circle, used when the page has a blank reference
+        self.reference_range = reference_range
+        # Circularity margin at which a contour scores as fully (non-)circular
+        self.shape_scale = 0.2
+
+    def detect(
+            self,
+            img_gray,
+            min_area=0.15,
+            max_area=0.9,
+            page: PageAnalysis = None,
+            coordinates: list[int] = None) -> bool:
+        return self.score(img_gray, min_area, max_area, page, coordinates).has_circle
+
+    def score(
+            self,
+            img_gray,
+            min_area=0.15,
+            max_area=0.9,
+            page: PageAnalysis = None,
+            coordinates: list[int] = None) -> EncirclementScore:
+        """
+        Score how clearly a region is encircled, see `detect`.
+
+        The score is 0.5 at the decision threshold. A circle found in the
+        region scores by the smaller of its circularity and area margins,
+        and a region without a circle by the circularity margin of its most
+        circular contour. Regions decided by their added ink score by how
+        far the added ink ratio is past the decision bound.
+
+        Returns:
+            EncirclementScore: Decision, score and measurements of the region
+        """
         # Binarization
-        _, img_binary = cv2.threshold(img_gray, 0, 255, cv2.THRESH_OTSU)
+        added_ratio = np.nan
+        if page is not None:
+            # A region without any ink cannot contain a circle
+            if page.ink_count(*coordinates) == 0:
+                return EncirclementScore(False, 0.0)
+            img_gray = page.gray_roi(*coordinates)
+            if page.has_reference:
+                low, high = self.reference_range
+                added_ratio = page.added_ratio(*coordinates)
+                if added_ratio <= low:
+                    margin = np.clip(1 - added_ratio / low, 0, 1)
+                    return EncirclementScore(False, float(0.5 - 0.5 * margin), added_ratio=added_ratio)
+                if added_ratio >= high:
+                    margin = np.clip(added_ratio / high - 1, 0, 1)
+                    return EncirclementScore(True, float(0.5 + 0.5 * margin), added_ratio=added_ratio)
+                # Only the pen marks, the printed option text is left out
+                img_binary = np.where(page.added_roi(*coordinates), 0, 255).astype(np.uint8)
+            else:
+                img_binary = page.binary_roi(*coordinates)
+        else:
+            _, img_binary = cv2.threshold(img_gray, 0, 255, cv2.THRESH_OTSU)
 
         # Contour Finding
         img_blur = cv2.GaussianBlur(img_binary, (3, 3), sigmaX=0, sigmaY=0)
         edges = cv2.Canny(image=img_blur, threshold1=100, threshold2=200)
-        contours, hierarchy = cv2.findContours(
-            edges, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_SIMPLE)
+        # Only the outermost contours are candidates
+        contours, _ = cv2.findContours(
+            edges, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
 
         # Contour Filtering
         orig_height, orig_width = img_gray.shape
         radius = min(orig_height, orig_width) / 3
         img_x, img_y = orig_width / 2, orig_height / 2
+        contours = self._prefilter(
+            contours, img_x, img_y, radius, 0.2 * orig_height * orig_width)
         contours_filtered = []
-        for i, cnt in enumerate(contours):
-            if hierarchy[0][i][3] != -1:
-                continue
+        best_shape_margin = -np.inf
+        for cnt in contours:
             cnt = cv2.convexHull(cnt)
             M = cv2.moments(cnt)
             if M["m00"] == 0:
@@ -29,42 +108,114 @@ class EncirclementDetector:
             dist = np.sqrt((cX - img_x) ** 2 + (cY - img_y) ** 2)
             if dist > radius:
                 continue
-            if not self._check_shape(cnt):
+            shape_margin = self._shape_margin(cnt)
+            best_shape_margin = max(best_shape_margin, shape_margin)
+            if shape_margin <= 0:
                 continue
 
+            contours_filtered.append((cnt, shape_margin))
 
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w * h < 0.2 * orig_height * orig_width:
-                continue
+        # Largest Contour and Area Check
+        largest = max(contours_filtered, key=lambda item: cv2.contourArea(item[0]), default=None)
 
-            contours_filtered.append(cnt)
+        if largest is None:
+            # A region without any candidate contour scores 0
+            margin = np.clip(best_shape_margin / self.shape_scale, -1, 0)
+            return EncirclementScore(
+                False, float(0.5 + 0.5 * margin),
+                shape_margin=best_shape_margin if np.isfinite(best_shape_margin) else np.nan,
+                added_ratio=added_ratio)
 
-        # Largest Contour and Area Check
-        largest_cnt = max(contours_filtered, key=cv2.contourArea, default=None)
+        largest_cnt, shape_margin = largest
+        orig_area = orig_height * orig_width
+        has_circle = self._check_area(largest_cnt, min_area, max_area, orig_area)
+        area_ratio = cv2.contourArea(largest_cnt) / orig_area
+        area_margin = min((area_ratio - min_area) / min_area, (max_area - area_ratio) / (1 - max_area))
+        margin = np.clip(min(area_margin, shape_margin / self.shape_scale), -1, 1)
+        return EncirclementScore(
+            has_circle, float(0.5 + 0.5 * margin),
+            area_ratio=area_ratio, shape_margin=shape_margin, added_ratio=added_ratio)
 
-        if largest_cnt is not None:
-            has_circle = self._check_area(
-                largest_cnt, min_area, max_area, orig_height * orig_width)
-        else:
-            has_circle = False
+    def _prefilter(self, contours, img_x, img_y, radius, min_box_area):
+        """
+        Drop the contours whose bounding box already rules them out.
 
-        # Return True or False
-        return has_circle
+        The bounding boxes of all the contours are computed at once with
+        NumPy, so noise specks are discarded without any per-contour
+        OpenCV call. A contour is kept if its box (the same as the box of
+        its convex hull) is large enough and comes within `radius` of the
+        image center, since the hull centroid lies inside the box.
+        """
+        if not contours:
+            return []
+
+        lengths = np.fromiter((len(cnt) for cnt in contours), dtype=np.intp, count=len(contours))
+        points = np.concatenate(contours).reshape(-1, 2)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        mins = np.minimum.reduceat(points, starts)
+        maxs = np.maximum.reduceat(points, starts)
+
+        sizes = maxs - mins + 1
+        keep = sizes[:, 0] * sizes[:, 1] >= min_box_area
+
+        # Distance from the image center to the closest point of the box
+        dx = np.maximum(np.maximum(mins[:, 0] - img_x, img_x - maxs[:, 0]), 0)
+        dy = np.maximum(np.maximum(mins[:, 1] - img_y, img_y - maxs[:, 1]), 0)
+        keep &= dx ** 2 + dy ** 2 <= radius ** 2
+
+        return [contours[i] for i in np.flatnonzero(keep)]
 
     def _check_area(self, cnt, min_area, max_area, orig_area):
         cnt_area = cv2.contourArea(cnt)
         area_ratio = cnt_area / orig_area
         return min_area <= area_ratio <= max_area
-        
-    def _check_shape(self, cnt):
+
+    def _shape_margin(self, cnt):
+        """Circularity of a contour minus the threshold for its aspect ratio."""
         perimeter = cv2.arcLength(cnt, True)
         area = cv2.contourArea(cnt)
         if perimeter == 0:
-            return False
+            return -np.inf
         circularity = 4 * np.pi * (area / (perimeter ** 2))
         x, y, w, h = cv2.boundingRect(cnt)
         aspect_ratio = w / h if h != 0 else 0
         if aspect_ratio < 1:
             aspect_ratio = 1 / aspect_ratio
         dynamic_threshold = max(0.6, 0.95 - (aspect_ratio - 1) * 0.2)
-        return circularity > dynamic_threshold
+        return circularity - dynamic_threshold
+
+
+def main():
+    # Benchmark of the contour pre-filter on regions with salt-and-pepper noise
+    rng = np.random.default_rng(0)
+    region = np.full((480, 1280), 255, np.uint8)
+    cv2.putText(region, 'Female', (280, 300), cv2.FONT_HERSHEY_SIMPLEX, 4.8, 0, 12)
+    cv2.ellipse(region, (640, 240), (560, 192), 0, 0, 360, 0, 12)
+
+    detector = EncirclementDetector()
+    unfiltered = EncirclementDetector()
+    unfiltered._prefilter = lambda contours, *args: list(contours)
+
+    repeats = 20
+    for density in [0, 0.01, 0.05, 0.1, 0.2]:
+        noisy = region.copy()
+        mask = rng.random(region.shape) < density
+        noisy[mask] = rng.integers(0, 256, mask.sum())
+
+        _, binary = cv2.threshold(noisy, 0, 255, cv2.THRESH_OTSU)
+        edges = cv2.Canny(cv2.GaussianBlur(binary, (3, 3), 0), 100, 200)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        timings = []
+        for current in [unfiltered, detector]:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                has_circle = current.detect(noisy)
+            timings.append((time.perf_counter() - start) / repeats * 1000)
+
+        print(f'noise {density:.2f}: {len(contours):5d} contours, '
+              f'{timings[0]:6.2f} ms without pre-filter, {timings[1]:6.2f} ms with pre-filter, circle: {has_circle}')
+
+
+if __name__ == '__main__':
+    main()
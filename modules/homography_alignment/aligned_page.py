@@ -0,0 +1,93 @@
+import numpy as np
+import cv2
+
+type MatLike = cv2.typing.MatLike
+
+
+class AlignedPage:
+    """
+    Scan together with the perspective matrix that aligns it to a template.
+
+    Regions are warped on demand from the part of the scan they map to, so
+    the full page only has to be warped when the whole aligned image is
+    needed, e.g. for a preview.
+    """
+    def __init__(
+            self,
+            image: MatLike,
+            matrix: np.ndarray,
+            length: int,
+            width: int,
+            ) -> None:
+        self.image = image
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.inverse = np.linalg.inv(self.matrix)
+        self.length = length
+        self.width = width
+        self._aligned: MatLike | None = None
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return (self.width, self.length) + self.image.shape[2:]
+
+    @property
+    def is_warped(self) -> bool:
+        return self._aligned is not None
+
+    def warp(self) -> MatLike:
+        """Warp the full page, the result is cached."""
+        if self._aligned is None:
+            self._aligned = cv2.warpPerspective(
+                self.image, self.matrix, (self.length, self.width))
+        return self._aligned
+
+    def replace_aligned(self, aligned: MatLike) -> 'AlignedPage':
+        """Same page with another aligned image, e.g. the preprocessed one."""
+        page = AlignedPage(self.image, self.matrix, self.length, self.width)
+        page._aligned = aligned
+        return page
+
+    def clip(self, x1: int, y1: int, x2: int, y2: int) -> tuple[int, int, int, int]:
+        """Clamp a region to the aligned page bounds."""
+        x1, x2 = min(max(x1, 0), self.length), min(max(x2, 0), self.length)
+        y1, y2 = min(max(y1, 0), self.width), min(max(y2, 0), self.width)
+        return x1, y1, x2, y2
+
+    def crop(self, x1: int, y1: int, x2: int, y2: int) -> MatLike:
+        """
+        Get a region of the aligned page without warping the full page.
+
+        Args:
+            x1, y1, x2, y2: Region in aligned page coordinates
+
+        Returns:
+            MatLike: The aligned region, a view if the full page is warped
+        """
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+
+        if self._aligned is not None:
+            return self._aligned[y1:y2, x1:x2]
+
+        if x2 <= x1 or y2 <= y1:
+            return self.image[0:0, 0:0]
+
+        # Map the region back onto the scan, with a margin for interpolation
+        rect = np.float64([[[x1, y1]], [[x2, y1]], [[x2, y2]], [[x1, y2]]])
+        quad = cv2.perspectiveTransform(rect, self.inverse).reshape(4, 2)
+        height, width = self.image.shape[:2]
+        sx1 = min(max(int(np.floor(quad[:, 0].min())) - 2, 0), width)
+        sy1 = min(max(int(np.floor(quad[:, 1].min())) - 2, 0), height)
+        sx2 = min(max(int(np.ceil(quad[:, 0].max())) + 3, 0), width)
+        sy2 = min(max(int(np.ceil(quad[:, 1].max())) + 3, 0), height)
+
+        if sx2 <= sx1 or sy2 <= sy1:
+            # The region lies outside the scan
+            return np.zeros((y2 - y1, x2 - x1) + self.image.shape[2:], self.image.dtype)
+
+        # Scan crop -> scan -> aligned page -> region
+        to_scan = np.float64([[1, 0, sx1], [0, 1, sy1], [0, 0, 1]])
+        to_region = np.float64([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]])
+        matrix = to_region @ self.matrix @ to_scan
+
+        return cv2.warpPerspective(
+            self.image[sy1:sy2, sx1:sx2], matrix, (x2 - x1, y2 - y1))
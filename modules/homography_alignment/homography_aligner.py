@@ -1,37 +1,304 @@
+from typing import Hashable, NamedTuple
+
 import numpy as np
 import cv2
 
+
 type MatLike = cv2.typing.MatLike
+type Window = tuple[int, int, int, int]
+
+# top-left, top-right, bottom-left, bottom-right
+CORNER_MARKER_IDS = (100, 101, 102, 103)
+
+
+class AlignmentQuality(NamedTuple):
+    # Reprojection error of the marker points not fit exactly, in template pixels
+    reprojection_error: float
+    max_reprojection_error: float
+    # Number of marker points the error is measured on
+    points: int
+    # Clockwise rotation of the page in the scan, None if inconsistent
+    orientation: int | None
+    # Scan pixels per template pixel
+    scale: float
+    # Ratio of the horizontal to the vertical scale
+    aspect_ratio: float
+    # Largest deviation of a page corner from a right angle, in degrees
+    skew: float
+    rejected: bool
+    reason: str
 
 
 class HomographyAligner:
-    def __init__(self, detector: cv2.aruco.ArucoDetector) -> None:
+    def __init__(
+            self,
+            detector: cv2.aruco.ArucoDetector,
+            pyramid_levels: int = 0,
+            refine_window: int = 5,
+            corner_fraction: float | None = 0.25,
+            prior_margin: float = 1.0,
+            ransac_threshold: float | None = None,
+            reuse_matrix: bool = False,
+            verify_threshold: float = 0.8,
+            verify_tolerance: int = 4,
+            ) -> None:
         self.arucodetector = detector
+        # Number of times the marker image is halved before detection,
+        # 0 detects on the full resolution image
+        self.pyramid_levels = pyramid_levels
+        # Minimum half size of the full resolution corner refinement window
+        self.refine_window = refine_window
+        # Size of the corner search windows as a fraction of the scan size,
+        # None always searches the full page
+        self.corner_fraction = corner_fraction
+        # Margin around the last found markers, in marker sizes
+        self.prior_margin = prior_margin
+        # Last found corner markers per scanner/template key
+        self.priors: dict[Hashable, dict[int, np.ndarray]] = {}
+        # Maximum reprojection error in pixels of a RANSAC inlier,
+        # None maps the four corner markers exactly
+        self.ransac_threshold = ransac_threshold
+        # Reuse the last matrix per scanner/template key if it still fits
+        self.reuse_matrix = reuse_matrix
+        # Minimum correlation of a marker warped with a reused matrix
+        self.verify_threshold = verify_threshold
+        # Largest shift of a marker from its last position, in template pixels
+        self.verify_tolerance = verify_tolerance
+        # Last matrix and markers per key
+        self.matrices: dict[Hashable, tuple[np.ndarray, dict[int, np.ndarray]]] = {}
+        self._marker_images: dict[tuple[int, int], np.ndarray] = {}
+
+    def detect_markers(
+            self,
+            marker_image: MatLike,
+            pyramid_levels: int = None,
+            ) -> tuple[list[np.ndarray], np.ndarray | None]:
+        """
+        Detect the ArUco markers in the image, coarse-to-fine if enabled.
+
+        The markers are detected on a downscaled pyramid level, then each
+        corner is scaled back and refined with `cornerSubPix` in a small
+        window of the full resolution image.
+
+        Args:
+            marker_image: Grayscale image used for marker detection
+            pyramid_levels: Overrides the number of pyramid levels
+
+        Returns:
+            tuple: Marker corners, each (1, 4, 2), and the marker ids (N, 1)
+        """
+        if pyramid_levels is None:
+            pyramid_levels = self.pyramid_levels
+
+        if pyramid_levels <= 0:
+            marker_corners, marker_ids, _ = self.arucodetector.detectMarkers(marker_image)
+            return marker_corners, marker_ids
+
+        small = marker_image
+        for _ in range(pyramid_levels):
+            small = cv2.pyrDown(small)
+
+        marker_corners, marker_ids, _ = self.arucodetector.detectMarkers(small)
+
+        if marker_ids is None:
+            # Markers may be too small for the downscaled image
+            marker_corners, marker_ids, _ = self.arucodetector.detectMarkers(marker_image)
+            return marker_corners, marker_ids
+
+        # Map the pixel centers of the pyramid level back to full resolution
+        scale = 2 ** pyramid_levels
+        points = (np.concatenate(marker_corners).reshape(-1, 1, 2) + 0.5) * scale - 0.5
+        points = points.astype(np.float32)
+
+        half_size = max(self.refine_window, scale)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+        cv2.cornerSubPix(
+            marker_image, points, (half_size, half_size), (-1, -1), criteria)
+
+        marker_corners = tuple(points.reshape(-1, 1, 4, 2))
+        return marker_corners, marker_ids
 
     def align(
             self,
             image: MatLike,
             marker_image: MatLike,
             length=1700,
-            width=2800
+            width=2800,
+            key: Hashable = None,
             ) -> MatLike:
 
-        marker_corners, marker_ids, _ = self.arucodetector.detectMarkers(marker_image)
+        matrix, _ = self.find_homography(marker_image, length, width, key)
+        return self.warp(image, matrix, length, width)
 
-        if marker_ids is None:
+    def find_homography(
+            self,
+            marker_image: MatLike,
+            length=1700,
+            width=2800,
+            key: Hashable = None,
+            search_corners: bool = True,
+            marker_positions: dict[int, list[float]] = None,
+            marker_size: float = 0,
+            ) -> tuple[np.ndarray, dict[int, np.ndarray]]:
+        """
+        Compute the perspective matrix that maps the scan onto the template.
+
+        Without a RANSAC threshold, the outer corners of the four corner
+        markers are mapped exactly onto the page corners. With one, every
+        detected marker with a known template position is used and the
+        homography is fit with RANSAC, so missing markers are tolerated.
+
+        Args:
+            marker_image: Grayscale image used for marker detection
+            length: Width of the aligned image in pixels
+            width: Height of the aligned image in pixels
+            key: Scanner/template key of the remembered marker positions
+            search_corners: Search the corner windows before the full page
+            marker_positions: Template [x, y] centers of the other markers,
+                or [x, y, size] for markers of another size
+            marker_size: Template side length of the corner markers, and of
+                the other markers without a size, 0 if unknown
+
+        Returns:
+            tuple: The 3x3 perspective matrix and the (4, 2) corners of every
+            detected marker in scan coordinates, keyed by marker id
+
+        Raises:
+            ValueError: If not enough markers are found
+        """
+        markers = None
+        if self.reuse_matrix and key in self.matrices:
+            # Steady state of a feed, the page sits about where the last one did
+            markers = self.verify_homography(marker_image, *self.matrices[key], length, width)
+
+        if markers is None:
+            markers = self.locate_markers(marker_image, key, search_corners)
+
+        matrix = self._fit_homography(
+            markers, length, width, key, marker_positions, marker_size)
+
+        if self.reuse_matrix and key is not None:
+            self.matrices[key] = (matrix, markers)
+
+        return matrix, markers
+
+    def verify_homography(
+            self,
+            marker_image: MatLike,
+            matrix: np.ndarray,
+            markers: dict[int, np.ndarray],
+            length=1700,
+            width=2800,
+            ) -> dict[int, np.ndarray] | None:
+        """
+        Find the markers of a scan around where a previous matrix puts them.
+
+        Each marker of the previous scan is warped with a window of
+        `verify_tolerance` pixels around it and correlated with the ideal
+        marker image, which is much cheaper than detecting the markers
+        again. The best match gives the shift of the marker on this scan.
+
+        Args:
+            marker_image: Grayscale image used for marker detection
+            matrix: Perspective matrix of the previous scan to the template
+            markers: (4, 2) corners of the markers of the previous scan
+            length: Width of the aligned image in pixels
+            width: Height of the aligned image in pixels
+
+        Returns:
+            dict: (4, 2) corners of the markers in this scan, keyed by id,
+            None if any of them is not found
+        """
+        if not any(id_ in markers for id_ in CORNER_MARKER_IDS):
+            return None
+
+        t = self.verify_tolerance
+        inverse = np.linalg.inv(matrix)
+        dictionary = self.arucodetector.getDictionary()
+        found = {}
+        for id_, corners in markers.items():
+            # Corners of the marker on the template, and its square there
+            corners = cv2.perspectiveTransform(
+                corners.reshape(-1, 1, 2).astype(np.float64), matrix).reshape(4, 2)
+            s = int(round(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1).mean()))
+            if s <= 0:
+                return None
+            x, y = np.round(corners.mean(axis=0) - s / 2).astype(int)
+
+            # Warp the window directly, it may stick out of the page
+            to_window = np.float64([[1, 0, t - x], [0, 1, t - y], [0, 0, 1]])
+            window = cv2.warpPerspective(
+                marker_image, to_window @ matrix, (s + 2 * t, s + 2 * t), borderValue=255)
+
+            if (id_, s) not in self._marker_images:
+                self._marker_images[(id_, s)] = cv2.aruco.generateImageMarker(dictionary, id_, s)
+            scores = cv2.matchTemplate(window, self._marker_images[(id_, s)], cv2.TM_CCOEFF_NORMED)
+            _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+            if not score >= self.verify_threshold:
+                return None
+
+            # Move the marker so its center is on the best match
+            center = np.float64([
+                x - t + dx + _subpixel_offset(scores[dy, dx - 1:dx + 2]),
+                y - t + dy + _subpixel_offset(scores[dy - 1:dy + 2, dx]),
+            ]) + s / 2
+            shift = center - corners.mean(axis=0)
+            found[id_] = cv2.perspectiveTransform(
+                (corners + shift).reshape(-1, 1, 2), inverse).reshape(4, 2).astype(np.float32)
+
+        return found
+
+    def _fit_homography(
+            self,
+            markers: dict[int, np.ndarray],
+            length: int,
+            width: int,
+            key: Hashable,
+            marker_positions: dict[int, list[float]],
+            marker_size: float,
+            ) -> np.ndarray:
+        if not markers:
             raise ValueError('No markers found')
 
-        marker_ids = marker_ids.flatten()
+        marker_dict = {id_: markers[id_] for id_ in CORNER_MARKER_IDS if id_ in markers}
 
-        marker_dict = {}
-        for i, id_ in enumerate(marker_ids):
-            if id_ in [100, 101, 102, 103]:
-                marker_dict[id_] = marker_corners[i][0]
+        # The destination of every marker point follows from its id and its
+        # corner order, which both rotate with the page, so rotated scans
+        # align without reordering as long as the layout is consistent
+        if marker_dict and self.infer_orientation(marker_dict) is None:
+            raise ValueError(
+                f"Inconsistent layout of markers {' '.join(str(k) for k in marker_dict.keys())}.")
+
+        if self.ransac_threshold is not None:
+            # Without a known marker size, all the corners of the corner
+            # markers are still used, so that a missing one is tolerated
+            if not marker_size:
+                marker_size = self._estimate_marker_size(marker_dict, length, width)
+            coords_markers, coords_transform = self._correspondences(
+                markers, length, width, marker_positions, marker_size)
+
+            if len(coords_markers) < 4:
+                raise ValueError(
+                    f"Found {len(coords_markers)} marker points in markers {' '.join(str(k) for k in markers.keys())}. At least 4 are needed.")
+
+            matrix, _ = cv2.findHomography(
+                coords_markers, coords_transform, cv2.RANSAC, self.ransac_threshold)
+
+            if matrix is None:
+                raise ValueError('Homography estimation failed')
+
+            if key is not None and marker_dict:
+                self.priors[key] = marker_dict
+
+            return matrix
 
         if len(marker_dict) < 4:
             raise ValueError(
                 f"Found {len(marker_dict)} markers {' '.join(str(k) for k in marker_dict.keys())}. Not all markers found.")
 
+        if key is not None:
+            self.priors[key] = marker_dict
+
         coords_markers = np.float32([
             marker_dict[100][0],  # top-left
             marker_dict[101][1],  # top-right
@@ -46,7 +313,442 @@ class HomographyAligner:
             [0, width],
         ])
 
-        matrix = cv2.getPerspectiveTransform(coords_markers, coords_transform)
-        aligned = cv2.warpPerspective(image, matrix, (length, width))
+        return cv2.getPerspectiveTransform(coords_markers, coords_transform)
+
+    def assess(
+            self,
+            matrix: np.ndarray,
+            markers: dict[int, np.ndarray],
+            length=1700,
+            width=2800,
+            marker_positions: dict[int, list[float]] = None,
+            marker_size: float = 0,
+            max_error: float = 10.0,
+            max_skew: float | None = None,
+            max_aspect_deviation: float | None = None,
+            scale_range: tuple[float, float] = (0.2, 10.0),
+            ) -> AlignmentQuality:
+        """
+        Measure how good an alignment is and decide if it should be rejected.
+
+        The reprojection error is measured on every corner of the markers,
+        except the page corners that the exact four-point fit maps by
+        construction. Without a template marker size, the markers are
+        compared with squares of their mean size on the aligned page, so
+        a distorted alignment still shows in the error.
+
+        Args:
+            matrix: Perspective matrix from the scan to the template
+            markers: (4, 2) marker corners in scan coordinates, keyed by id
+            length: Width of the aligned image in pixels
+            width: Height of the aligned image in pixels
+            marker_positions: Template centers of the other markers, see
+                `find_homography`
+            marker_size: Template side length of the markers, 0 if unknown
+            max_error: Maximum reprojection error of a marker point
+            max_skew: Maximum deviation of a page corner from a right angle,
+                None to not check it
+            max_aspect_deviation: Maximum deviation of the aspect ratio from 1,
+                None to not check it
+            scale_range: Minimum and maximum scan pixels per template pixel
+
+        Returns:
+            AlignmentQuality: Alignment metrics and the reject status
+        """
+        # Reprojection error of every marker point with a known position
+        if not marker_size:
+            marker_size = self._template_marker_size(matrix, markers)
+        src, dst = self._correspondences(
+            markers, length, width, marker_positions, marker_size)
+        if self.ransac_threshold is None and len(dst):
+            # The page corners were not measured but fit exactly
+            page_corners = np.float32([[0, 0], [length, 0], [length, width], [0, width]])
+            fitted = (dst[:, None] == page_corners[None]).all(axis=2).any(axis=1)
+            src, dst = src[~fitted], dst[~fitted]
+        if len(src):
+            projected = cv2.perspectiveTransform(src.reshape(-1, 1, 2), matrix).reshape(-1, 2)
+            errors = np.linalg.norm(projected - dst, axis=1)
+            error, max_error_ = float(errors.mean()), float(errors.max())
+        else:
+            error, max_error_ = 0.0, 0.0
+
+        corner_markers = {id_: markers[id_] for id_ in CORNER_MARKER_IDS if id_ in markers}
+        orientation = self.infer_orientation(corner_markers) if corner_markers else None
+
+        # Page outline in the scan: top-left, top-right, bottom-right, bottom-left
+        page = np.float64([[[0, 0]], [[length, 0]], [[length, width]], [[0, width]]])
+        quad = cv2.perspectiveTransform(page, np.linalg.inv(matrix)).reshape(4, 2)
+        edges = np.roll(quad, -1, axis=0) - quad
+        sides = np.linalg.norm(edges, axis=1)
+        scale_x = (sides[0] + sides[2]) / (2 * length)
+        scale_y = (sides[1] + sides[3]) / (2 * width)
+        scale = float((scale_x + scale_y) / 2)
+        aspect_ratio = float(scale_x / scale_y) if scale_y else 0.0
+
+        skew = 0.0
+        for i in range(4):
+            a, b = -edges[i - 1], edges[i]
+            norm = np.linalg.norm(a) * np.linalg.norm(b)
+            if norm == 0:
+                skew = 90.0
+                break
+            angle = np.degrees(np.arccos(np.clip(a @ b / norm, -1, 1)))
+            skew = max(skew, float(abs(angle - 90)))
+
+        # Fast failure classification, the first failed check is reported
+        if corner_markers and orientation is None:
+            reason = 'inconsistent marker layout'
+        elif max_error_ > max_error:
+            reason = f'reprojection error {max_error_:.1f} px'
+        elif not scale_range[0] <= scale <= scale_range[1]:
+            reason = f'scale {scale:.2f}'
+        elif max_aspect_deviation is not None and abs(aspect_ratio - 1) > max_aspect_deviation:
+            reason = f'aspect ratio {aspect_ratio:.2f}'
+        elif max_skew is not None and skew > max_skew:
+            reason = f'skew {skew:.1f} deg'
+        else:
+            reason = ''
+
+        return AlignmentQuality(
+            reprojection_error=error,
+            max_reprojection_error=max_error_,
+            points=len(src),
+            orientation=orientation,
+            scale=scale,
+            aspect_ratio=aspect_ratio,
+            skew=skew,
+            rejected=bool(reason),
+            reason=reason,
+        )
+
+    def infer_orientation(self, markers: dict[int, np.ndarray]) -> int | None:
+        """
+        Infer the rotation of the page in the scan from the corner markers.
+
+        The rotation is read from where each corner marker id was found
+        relative to the others, and from the corner order of the markers
+        themselves, so no extra detection is needed.
+
+        Args:
+            markers: (4, 2) corners of the found corner markers, keyed by id
+
+        Returns:
+            int: Clockwise rotation of the page in degrees (0, 90, 180 or
+            270), or None if the markers disagree on the rotation
+        """
+        # Rotation of each marker from its top edge
+        votes = []
+        for corners in markers.values():
+            dx, dy = corners[1] - corners[0]
+            votes.append(int(round(np.degrees(np.arctan2(dy, dx)) / 90)) % 4 * 90)
+        orientation = max(set(votes), key=votes.count)
+
+        if votes.count(orientation) * 2 <= len(votes):
+            return None
+
+        # Rotation of the layout, each pair of markers must point the same
+        # way as in the template once rotated
+        layout = {100: (-1, -1), 101: (1, -1), 102: (-1, 1), 103: (1, 1)}
+        rotations = {0: ((1, 0), (0, 1)), 90: ((0, -1), (1, 0)), 180: ((-1, 0), (0, -1)), 270: ((0, 1), (-1, 0))}
+        rotation = np.float64(rotations[orientation])
+        centers = {id_: corners.mean(axis=0) for id_, corners in markers.items()}
+        ids = list(centers.keys())
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                expected = rotation @ (np.float64(layout[b]) - layout[a])
+                found = centers[b] - centers[a]
+                norm = np.linalg.norm(expected) * np.linalg.norm(found)
+                if norm == 0 or expected @ found / norm < 0.5:
+                    return None
+
+        return orientation
+
+    def measure_marker_positions(
+            self,
+            marker_image: MatLike,
+            length=1700,
+            width=2800,
+            ) -> tuple[dict[int, list[float]], float]:
+        """
+        Measure the template positions of the markers on a reference scan.
+
+        The scan is aligned with the corner markers and every other marker
+        is mapped onto the template, to fill in the `marker_positions` and
+        `marker_size` of a template, see measure_markers.py.
+
+        Args:
+            marker_image: Grayscale image of a clean reference scan
+            length: Width of the aligned image in pixels
+            width: Height of the aligned image in pixels
+
+        Returns:
+            tuple: [x, y, size] center and side length of the other markers
+            keyed by id, and the mean side length of the corner markers, in
+            template pixels
+        """
+        ransac_threshold = self.ransac_threshold
+        self.ransac_threshold = None
+        try:
+            matrix, markers = self.find_homography(
+                marker_image, length, width, search_corners=False)
+        finally:
+            self.ransac_threshold = ransac_threshold
+
+        ids = list(markers.keys())
+        corners = np.float32([markers[id_] for id_ in ids]).reshape(-1, 1, 2)
+        corners = cv2.perspectiveTransform(corners, matrix).reshape(-1, 4, 2)
+
+        # Region markers may be printed in another size than the corner ones
+        sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2).mean(axis=1)
+        positions = {}
+        corner_sides = []
+        for id_, points, side in zip(ids, corners, sides.tolist()):
+            if id_ in CORNER_MARKER_IDS:
+                corner_sides.append(side)
+                continue
+            center = points.mean(axis=0)
+            positions[id_] = [round(float(center[0]), 1), round(float(center[1]), 1), round(side, 1)]
+
+        marker_size = round(float(np.mean(corner_sides)), 1)
+
+        return positions, marker_size
+
+    def locate_markers(
+            self,
+            marker_image: MatLike,
+            key: Hashable = None,
+            search_corners: bool = True,
+            ) -> dict[int, np.ndarray]:
+        """
+        Find the markers, searching small windows before the full page.
+
+        The corner markers are first searched around their last found
+        positions for `key`, then in the corner windows of the scan that
+        do not contain one yet, whatever the orientation of the page. The
+        full page is only searched if any of them is still missing.
+
+        Args:
+            marker_image: Grayscale image used for marker detection
+            key: Scanner/template key of the remembered marker positions
+            search_corners: Search the windows before the full page
+
+        Returns:
+            dict: (4, 2) corners of the found markers in scan coordinates
+        """
+        if search_corners and self.corner_fraction:
+            markers: dict[int, np.ndarray] = {}
+            for id_, window in self._prior_windows(marker_image.shape, key).items():
+                if id_ not in markers:
+                    markers.update(self._detect_in_window(marker_image, window))
+            # The marker of a corner window depends on the orientation of
+            # the page, so a window is searched unless a corner marker was
+            # already found in it
+            for window in self._corner_windows(marker_image.shape).values():
+                if all(id_ in markers for id_ in CORNER_MARKER_IDS):
+                    return markers
+                if not any(
+                        _in_window(_projected_center(markers[id_]), window)
+                        for id_ in CORNER_MARKER_IDS if id_ in markers):
+                    markers.update(self._detect_in_window(marker_image, window))
+            if all(id_ in markers for id_ in CORNER_MARKER_IDS):
+                return markers
+
+        marker_corners, marker_ids = self.detect_markers(marker_image)
+        markers = self._to_dict(marker_corners, marker_ids)
+
+        if not all(id_ in markers for id_ in CORNER_MARKER_IDS) and self.pyramid_levels > 0:
+            # Retry on the full resolution image
+            marker_corners, marker_ids = self.detect_markers(marker_image, 0)
+            markers = self._to_dict(marker_corners, marker_ids)
+
+        return markers
+
+    def warp(
+            self,
+            image: MatLike,
+            matrix: np.ndarray,
+            length=1700,
+            width=2800
+            ) -> MatLike:
+        return cv2.warpPerspective(image, matrix, (length, width))
+
+    def _template_marker_size(
+            self,
+            matrix: np.ndarray,
+            markers: dict[int, np.ndarray],
+            ) -> float:
+        """Mean side length of the corner markers on the template."""
+        corners = [markers[id_] for id_ in CORNER_MARKER_IDS if id_ in markers]
+        if not corners:
+            return 0.0
+        corners = cv2.perspectiveTransform(
+            np.float32(corners).reshape(-1, 1, 2), matrix).reshape(-1, 4, 2)
+        sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+        return float(sides.mean())
+
+    def _estimate_marker_size(
+            self,
+            markers: dict[int, np.ndarray],
+            length: int,
+            width: int,
+            ) -> float:
+        """
+        Estimate the template side length of the markers from the scan.
+
+        The scan scale is the distance between the outer corners of two
+        corner markers over the distance between their page corners.
+
+        Args:
+            markers: (4, 2) corners of the found corner markers, keyed by id
+            length: Width of the aligned image in pixels
+            width: Height of the aligned image in pixels
+
+        Returns:
+            float: Template side length of the markers, 0 if fewer than two
+            corner markers were found
+        """
+        # Corner index and page corner of the outer corner of each marker
+        outer = {
+            100: (0, (0, 0)),
+            101: (1, (length, 0)),
+            103: (2, (length, width)),
+            102: (3, (0, width)),
+        }
+        ids = [id_ for id_ in outer if id_ in markers]
+        if len(ids) < 2:
+            return 0.0
+
+        scales = []
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                found = markers[b][outer[b][0]] - markers[a][outer[a][0]]
+                expected = np.subtract(outer[b][1], outer[a][1])
+                scales.append(np.linalg.norm(found) / np.linalg.norm(expected))
+
+        corners = np.float64([markers[id_] for id_ in ids])
+        sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+        return float(sides.mean() / np.mean(scales))
+
+    def _correspondences(
+            self,
+            markers: dict[int, np.ndarray],
+            length: int,
+            width: int,
+            marker_positions: dict[int, list[float]] = None,
+            marker_size: float = 0,
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """Pair the detected marker points with their template positions."""
+        s = marker_size
+        src = []
+        dst = []
+
+        # The outer corner of each corner marker lies on a page corner
+        outer = {
+            100: (0, (0, 0)),
+            101: (1, (length, 0)),
+            103: (2, (length, width)),
+            102: (3, (0, width)),
+        }
+        for id_, (corner, (x, y)) in outer.items():
+            if id_ not in markers:
+                continue
+            if s > 0:
+                # Top-left of the marker, then all its corners clockwise
+                x = x - s if corner in (1, 2) else x
+                y = y - s if corner in (2, 3) else y
+                src.extend(markers[id_])
+                dst.extend([(x, y), (x + s, y), (x + s, y + s), (x, y + s)])
+            else:
+                src.append(markers[id_][corner])
+                dst.append((x, y))
+
+        for id_, (x, y, *size) in (marker_positions or {}).items():
+            if id_ in outer or id_ not in markers:
+                continue
+            if size or s > 0:
+                h = (size[0] if size else s) / 2
+                src.extend(markers[id_])
+                dst.extend([(x - h, y - h), (x + h, y - h), (x + h, y + h), (x - h, y + h)])
+            else:
+                src.append(_projected_center(markers[id_]))
+                dst.append((x, y))
+
+        return np.float32(src).reshape(-1, 2), np.float32(dst).reshape(-1, 2)
+
+    def _detect_in_window(
+            self,
+            marker_image: MatLike,
+            window: Window,
+            ) -> dict[int, np.ndarray]:
+        x1, y1, x2, y2 = window
+        if x2 <= x1 or y2 <= y1:
+            # The remembered position is outside of this scan
+            return {}
+        marker_corners, marker_ids = self.detect_markers(marker_image[y1:y2, x1:x2])
+        markers = self._to_dict(marker_corners, marker_ids)
+        return {id_: corners + np.float32([x1, y1]) for id_, corners in markers.items()}
+
+    def _corner_windows(self, shape: tuple[int, ...]) -> dict[int, Window]:
+        h, w = shape[:2]
+        fw = int(w * self.corner_fraction)
+        fh = int(h * self.corner_fraction)
+        return {
+            100: (0, 0, fw, fh),
+            101: (w - fw, 0, w, fh),
+            102: (0, h - fh, fw, h),
+            103: (w - fw, h - fh, w, h),
+        }
+
+    def _prior_windows(self, shape: tuple[int, ...], key: Hashable) -> dict[int, Window]:
+        h, w = shape[:2]
+        windows = {}
+        for id_, corners in self.priors.get(key, {}).items():
+            x1, y1 = corners.min(axis=0)
+            x2, y2 = corners.max(axis=0)
+            margin = self.prior_margin * max(x2 - x1, y2 - y1)
+            windows[id_] = (
+                max(int(x1 - margin), 0),
+                max(int(y1 - margin), 0),
+                min(int(x2 + margin) + 1, w),
+                min(int(y2 + margin) + 1, h),
+            )
+        return windows
+
+    def _to_dict(
+            self,
+            marker_corners: list[np.ndarray],
+            marker_ids: np.ndarray | None,
+            ) -> dict[int, np.ndarray]:
+        if marker_ids is None:
+            return {}
+        return {
+            int(id_): corners.reshape(4, 2)
+            for id_, corners in zip(marker_ids.flatten(), marker_corners)
+        }
+
+
+def _subpixel_offset(scores: np.ndarray) -> float:
+    """Offset of the peak of a parabola through 3 scores around a maximum."""
+    if len(scores) < 3:
+        return 0.0
+    denom = scores[0] - 2 * scores[1] + scores[2]
+    if denom >= 0:
+        return 0.0
+    return float(np.clip((scores[0] - scores[2]) / (2 * denom), -0.5, 0.5))
+
+
+def _projected_center(corners: np.ndarray) -> np.ndarray:
+    """Intersection of the diagonals, the image of the marker center."""
+    p0, p1, p2, p3 = corners.astype(np.float64)
+    d1 = p2 - p0
+    d2 = p3 - p1
+    denom = d1[0] * d2[1] - d1[1] * d2[0]
+    if denom == 0:
+        return corners.mean(axis=0)
+    t = ((p1[0] - p0[0]) * d2[1] - (p1[1] - p0[1]) * d2[0]) / denom
+    return p0 + t * d1
+
 
-        return aligned
+def _in_window(point: np.ndarray, window: Window) -> bool:
+    x1, y1, x2, y2 = window
+    return x1 <= point[0] < x2 and y1 <= point[1] < y2
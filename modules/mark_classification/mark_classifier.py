@@ -0,0 +1,146 @@
+import cv2
+import numpy as np
+
+# type hinting
+from cv2.typing import MatLike
+
+
+class MarkClassifier:
+    """
+    Logistic regression on downsampled crops of checkbox or encirclement regions.
+
+    Every crop is reduced to a `size` x `size` ink image, so the marks of all
+    the regions of a page are classified with a single matrix product. The
+    model is trained from regions whose value is known, e.g. the JSON files
+    saved by the batch processing after a review.
+    """
+    def __init__(self, size: int = 32):
+        # Side of the downsampled crops
+        self.size = size
+        # Weights of the standardized features and bias, set by `fit` or `load`
+        self.weights: np.ndarray | None = None
+        self.bias = 0.0
+        # Mean and standard deviation of the training features
+        self.mean: np.ndarray | None = None
+        self.std: np.ndarray | None = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.weights is not None
+
+    def features(self, crops: list[MatLike]) -> np.ndarray:
+        """
+        Downsample the crops into ink images.
+
+        Args:
+            crops: Grayscale or BGR region crops of any size
+
+        Returns:
+            np.ndarray: (N, size * size) ink level of every pixel, from 0 to 1
+        """
+        features = np.zeros((len(crops), self.size * self.size), dtype=np.float32)
+        for i, crop in enumerate(crops):
+            if crop.size == 0:
+                continue
+            if crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(crop, (self.size, self.size), interpolation=cv2.INTER_AREA)
+            features[i] = 1 - small.reshape(-1) / np.float32(255)
+        return features
+
+    def predict_proba(self, crops: list[MatLike]) -> np.ndarray:
+        """
+        Probability that each region is marked.
+
+        Args:
+            crops: Region crops, see `features`
+
+        Returns:
+            np.ndarray: (N,) probabilities from 0 to 1
+        """
+        if not self.is_trained:
+            raise ValueError('The mark classifier is not trained')
+        if not crops:
+            return np.zeros(0)
+        x = (self.features(crops) - self.mean) / self.std
+        return self._sigmoid(x @ self.weights + self.bias)
+
+    def predict(self, crops: list[MatLike]) -> np.ndarray:
+        """(N,) True for the marked regions."""
+        return self.predict_proba(crops) > 0.5
+
+    def fit(
+            self,
+            crops: list[MatLike],
+            labels: list[bool],
+            epochs: int = 500,
+            learning_rate: float = 0.5,
+            l2: float = 1e-3) -> 'MarkClassifier':
+        """
+        Train the classifier with full-batch gradient descent.
+
+        Both classes weigh the same in the loss, however rare the marked
+        regions are.
+
+        Args:
+            crops: Region crops, see `features`
+            labels: True for the marked regions
+            epochs: Number of gradient steps
+            learning_rate: Step size
+            l2: Weight decay
+
+        Returns:
+            MarkClassifier: The trained classifier
+
+        Raises:
+            ValueError: If the labels do not contain both classes
+        """
+        y = np.asarray(labels, dtype=np.float64)
+        if len(y) != len(crops):
+            raise ValueError(f'Got {len(crops)} crops but {len(y)} labels')
+        positives = int(y.sum())
+        if positives == 0 or positives == len(y):
+            raise ValueError('Training needs both marked and empty regions')
+
+        features = self.features(crops)
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0) + 1e-3
+        x = (features - self.mean) / self.std
+
+        sample_weights = np.where(y == 1, 0.5 / positives, 0.5 / (len(y) - positives))
+        self.weights = np.zeros(x.shape[1])
+        self.bias = 0.0
+        for _ in range(epochs):
+            error = (self._sigmoid(x @ self.weights + self.bias) - y) * sample_weights
+            self.weights -= learning_rate * (x.T @ error + l2 * self.weights)
+            self.bias -= learning_rate * float(error.sum())
+        return self
+
+    def save(self, path: str) -> None:
+        """Save the trained model to a `.npz` file."""
+        if not self.is_trained:
+            raise ValueError('The mark classifier is not trained')
+        np.savez(path, size=self.size, weights=self.weights, bias=self.bias, mean=self.mean, std=self.std)
+
+    @classmethod
+    def load(cls, path: str) -> 'MarkClassifier':
+        """
+        Load a model saved with `save`.
+
+        Raises:
+            ValueError: If the file is not a saved mark classifier
+        """
+        try:
+            with np.load(path) as data:
+                classifier = cls(int(data['size']))
+                classifier.weights = data['weights']
+                classifier.bias = float(data['bias'])
+                classifier.mean = data['mean']
+                classifier.std = data['std']
+        except (OSError, KeyError) as e:
+            raise ValueError(f'Could not load mark classifier {path}: {e}')
+        return classifier
+
+    @staticmethod
+    def _sigmoid(z: np.ndarray) -> np.ndarray:
+        return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
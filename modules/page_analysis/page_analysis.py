@@ -0,0 +1,125 @@
+import cv2
+import numpy as np
+
+# type hinting
+from cv2.typing import MatLike
+Rect = tuple[int, int, int, int]
+
+
+class PageAnalysis:
+    """Binarized plane and integral image of an aligned page.
+
+    Computed once per page after alignment so that detectors can count the
+    dark (ink) pixels inside any rectangle in constant time instead of
+    thresholding and counting every cropped region separately.
+
+    With the ink mask of the aligned blank form as `reference`, the ink
+    added on the page (pen marks) is counted the same way.
+    """
+    def __init__(self, image: MatLike, reference: MatLike = None) -> None:
+        if image.ndim == 3:
+            self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            self.gray = image
+
+        # Page-level binarization (ink is black, paper is white)
+        _, self.binary = cv2.threshold(self.gray, 0, 255, cv2.THRESH_OTSU)
+
+        # Ink mask (1 for ink) and its integral image, shape (h + 1, w + 1)
+        self.ink = (self.binary == 0).astype(np.uint8)
+        self.integral = cv2.integral(self.ink)
+
+        self.height, self.width = self.gray.shape
+
+        # Ink that is not printed on the blank form and its integral image
+        self.added = None
+        self.added_integral = None
+        if reference is not None:
+            if reference.shape != self.ink.shape:
+                raise ValueError(f'Reference shape {reference.shape} does not match the page shape {self.ink.shape}')
+            self.added = cv2.bitwise_and(self.ink, 1 - reference)
+            self.added_integral = cv2.integral(self.added)
+
+    @property
+    def has_reference(self) -> bool:
+        return self.added is not None
+
+    def clip(self, x1: int, y1: int, x2: int, y2: int) -> Rect:
+        """Clamp a rectangle to the page bounds."""
+        x1 = min(max(int(x1), 0), self.width)
+        x2 = min(max(int(x2), 0), self.width)
+        y1 = min(max(int(y1), 0), self.height)
+        y2 = min(max(int(y2), 0), self.height)
+        return x1, y1, max(x1, x2), max(y1, y2)
+
+    def clip_many(self, rects: np.ndarray) -> np.ndarray:
+        """Clamp (N, 4) rectangles [x1, y1, x2, y2] to the page bounds."""
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+        xs = np.clip(rects[:, 0::2], 0, self.width)
+        ys = np.clip(rects[:, 1::2], 0, self.height)
+        return np.stack([
+            xs[:, 0], ys[:, 0],
+            np.maximum(xs[:, 0], xs[:, 1]), np.maximum(ys[:, 0], ys[:, 1]),
+        ], axis=1)
+
+    def ink_count(self, x1: int, y1: int, x2: int, y2: int) -> int:
+        """Number of ink pixels in the rectangle [x1, x2) x [y1, y2)."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        s = self.integral
+        return int(s[y2, x2] - s[y1, x2] - s[y2, x1] + s[y1, x1])
+
+    def ink_ratio(self, x1: int, y1: int, x2: int, y2: int) -> float:
+        """Fraction of ink pixels in the rectangle, 0 for empty rectangles."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        area = (x2 - x1) * (y2 - y1)
+        if area == 0:
+            return 0.0
+        return self.ink_count(x1, y1, x2, y2) / area
+
+    def ink_ratios(self, rects: np.ndarray) -> np.ndarray:
+        """Fraction of ink pixels in each of the (N, 4) rectangles at once."""
+        return self._ratios(self.integral, rects)
+
+    def added_ratio(self, x1: int, y1: int, x2: int, y2: int) -> float:
+        """Fraction of added ink pixels in the rectangle, needs a reference."""
+        return float(self._ratios(self.added_integral, [[x1, y1, x2, y2]])[0])
+
+    def added_ratios(self, rects: np.ndarray) -> np.ndarray:
+        """Fraction of added ink pixels in each of the (N, 4) rectangles at once."""
+        return self._ratios(self.added_integral, rects)
+
+    def _ratios(self, integral: np.ndarray, rects: np.ndarray) -> np.ndarray:
+        x1, y1, x2, y2 = self.clip_many(rects).T
+        s = integral
+        counts = s[y2, x2] - s[y1, x2] - s[y2, x1] + s[y1, x1]
+        areas = (x2 - x1) * (y2 - y1)
+        return np.divide(counts, areas, out=np.zeros(len(areas)), where=areas > 0)
+
+    def is_blank(
+            self,
+            x1: int, y1: int, x2: int, y2: int,
+            inset: int = 0,
+            max_ratio: float = 0.001) -> bool:
+        """Check if a rectangle (shrunk by `inset` pixels) has no ink."""
+        return self.ink_ratio(
+            x1 + inset, y1 + inset, x2 - inset, y2 - inset) <= max_ratio
+
+    def ink_roi(self, x1: int, y1: int, x2: int, y2: int) -> MatLike:
+        """View of the ink mask inside the rectangle."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        return self.ink[y1:y2, x1:x2]
+
+    def added_roi(self, x1: int, y1: int, x2: int, y2: int) -> MatLike:
+        """View of the added ink mask inside the rectangle, needs a reference."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        return self.added[y1:y2, x1:x2]
+
+    def binary_roi(self, x1: int, y1: int, x2: int, y2: int) -> MatLike:
+        """View of the binarized page inside the rectangle."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        return self.binary[y1:y2, x1:x2]
+
+    def gray_roi(self, x1: int, y1: int, x2: int, y2: int) -> MatLike:
+        """View of the grayscale page inside the rectangle."""
+        x1, y1, x2, y2 = self.clip(x1, y1, x2, y2)
+        return self.gray[y1:y2, x1:x2]
@@ -0,0 +1,311 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pydantic import BaseModel, Field, field_validator
+from typing import Callable, List
+import cv2
+import numpy as np
+
+# type hinting
+from cv2.typing import MatLike
+
+# Structuring element shape of every kernel shape name
+KERNEL_SHAPES = {
+    'Rectangular': cv2.MORPH_RECT,
+    'Elliptical': cv2.MORPH_ELLIPSE,
+    'Cross-shaped': cv2.MORPH_CROSS,
+}
+
+
+class PreprocessingConfig(BaseModel):
+    """Model representing the preprocessing settings of a template"""
+    # Homography alignment: morphological closing of the fiducials
+    fiducial_enhancement: bool = True
+    kernel_shape: str = 'Rectangular'
+    kernel_size: List[int] = Field([3, 3], min_items=2, max_items=2)
+    iterations: int = Field(1, ge=1)
+
+    # Homography alignment: brightness and contrast
+    brightness_contrast: bool = True
+    alpha: float = Field(1.5, gt=0)
+    beta: float = 10.0
+
+    # Data extraction: fast non-local means denoising
+    denoising: bool = True
+    filter_strength: float = Field(10.0, gt=0)
+    template_window_size: int = Field(7, ge=1)
+    search_window_size: int = Field(21, ge=1)
+
+    # Data extraction: contrast limited adaptive histogram equalization
+    clahe: bool = False
+    clip_limit: float = Field(40.0, gt=0)
+    tile_grid_size: List[int] = Field([8, 8], min_items=2, max_items=2)
+
+    @field_validator('kernel_shape')
+    def validate_kernel_shape(cls, v):
+        """Validate kernel shape is one of the supported shapes"""
+        if v not in KERNEL_SHAPES:
+            raise ValueError(f'Invalid kernel shape: {v}. Supported shapes: {", ".join(KERNEL_SHAPES)}') # noqa
+        return v
+
+    @field_validator('kernel_size', 'tile_grid_size')
+    def validate_size(cls, v):
+        """Validate sizes are positive (x, y) pairs"""
+        if len(v) != 2 or min(v) < 1:
+            raise ValueError('Sizes must have exactly 2 positive values [x, y]') # noqa
+        return v
+
+
+class PreprocessingPipeline:
+    """
+    Preprocessing steps of the scans, independent of the UI.
+
+    The structuring element and the CLAHE object are created once from the
+    configuration and reused for every page.
+
+    The local steps (closing, brightness/contrast and denoising) split the
+    page into tiles processed on a thread pool. Every tile is processed
+    with a margin as wide as the neighbourhood the step looks at, so the
+    stitched result is identical to processing the page in one pass.
+
+    Denoising can be restricted to the regions of a template, since the
+    rest of the page is printed form that is never read.
+    """
+    def __init__(self, config: PreprocessingConfig = None, tile_size: int = None) -> None:
+        self.config = config if config is not None else PreprocessingConfig()
+        # Side of the tiles processed in parallel, 0 for a single pass.
+        # Tiles only pay off with several cores, their margins are overhead
+        if tile_size is None:
+            tile_size = 512 if (os.cpu_count() or 1) > 1 else 0
+        self.tile_size = tile_size
+
+        self.structuring_element = cv2.getStructuringElement(
+            shape=KERNEL_SHAPES[self.config.kernel_shape],
+            ksize=tuple(self.config.kernel_size))
+        self.clahe = cv2.createCLAHE(
+            clipLimit=self.config.clip_limit,
+            tileGridSize=tuple(self.config.tile_grid_size))
+
+        # The window sizes of the denoising must be odd
+        self.template_window_size = self.config.template_window_size | 1
+        self.search_window_size = self.config.search_window_size | 1
+        # Distance up to which the denoising of a pixel looks at other pixels
+        self.denoising_margin = self.search_window_size // 2 + self.template_window_size // 2
+        # Same for the closing, a dilation and an erosion per iteration
+        self.closing_margin = 2 * self.config.iterations * max(self.config.kernel_size)
+
+    @property
+    def has_data_extraction_steps(self) -> bool:
+        return self.config.denoising or self.config.clahe
+
+    def apply_homography_preprocessing(self, image: MatLike) -> MatLike:
+        """
+        Enhance the fiducial markers of a scan before the alignment.
+
+        Args:
+            image: Grayscale scan
+
+        Returns:
+            MatLike: The preprocessed scan, the input itself if every step is disabled
+        """
+        config = self.config
+        if not (config.fiducial_enhancement or config.brightness_contrast):
+            return image
+
+        height, width = image.shape[:2]
+        margin = self.closing_margin if config.fiducial_enhancement else 0
+        return self.apply_tiled(
+            self._enhance_markers, image, [(0, 0, width, height)], margin, np.empty_like(image))
+
+    def _enhance_markers(self, image: MatLike) -> MatLike:
+        config = self.config
+
+        # Morphological Closing
+        if config.fiducial_enhancement:
+            image = cv2.morphologyEx(
+                src=image, op=cv2.MORPH_CLOSE, kernel=self.structuring_element,
+                iterations=config.iterations)
+
+        # Brightness and Contrast
+        if config.brightness_contrast:
+            image = cv2.convertScaleAbs(image, alpha=config.alpha, beta=config.beta)
+
+        return image
+
+    def apply_data_extraction_preprocessing(
+            self,
+            image: MatLike,
+            rects: np.ndarray = None,
+            grayscale: np.ndarray = None) -> MatLike:
+        """
+        Clean up an aligned page before the data extraction.
+
+        Args:
+            image: Aligned BGR page
+            rects: (N, 4) regions [x1, y1, x2, y2] to denoise, the whole
+                page if not given
+            grayscale: (N,) True for the regions only read in grayscale,
+                which are denoised in grayscale, a lot faster than in color
+
+        Returns:
+            MatLike: The preprocessed page, the input itself if every step is disabled
+        """
+        config = self.config
+
+        # Denoising (Fast Non-Local Means Denoising)
+        if config.denoising:
+            if rects is None:
+                height, width = image.shape[:2]
+                image = self.apply_tiled(
+                    self._denoise, image, [(0, 0, width, height)], self.denoising_margin, np.empty_like(image))
+            else:
+                image = self.denoise_regions(image, rects, grayscale)
+
+        # Contrast Enhancement (CLAHE), cheap and computed from tile
+        # histograms of the whole page, so it is always done in one pass
+        if config.clahe:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            image = self.clahe.apply(image)
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        return image
+
+    def denoise_regions(
+            self,
+            image: MatLike,
+            rects: np.ndarray,
+            grayscale: np.ndarray = None) -> MatLike:
+        """
+        Denoise the regions of a page only, see `apply_data_extraction_preprocessing`.
+
+        Nearby regions are denoised together. The grayscale regions are
+        written back to every channel of the page.
+
+        Returns:
+            MatLike: Copy of the page with the regions denoised
+        """
+        height, width = image.shape[:2]
+        rects = np.asarray(rects, dtype=int).reshape(-1, 4)
+        if grayscale is None:
+            grayscale = np.zeros(len(rects), dtype=bool)
+        grayscale = np.asarray(grayscale, dtype=bool)
+
+        # Color regions last, so they win where they overlap grayscale ones
+        result = image.copy()
+        for is_gray in [True, False]:
+            selected = rects[grayscale == is_gray]
+            # Clamp to the page and drop empty regions
+            selected = np.clip(selected, 0, [width, height, width, height])
+            selected = selected[(selected[:, 2] > selected[:, 0]) & (selected[:, 3] > selected[:, 1])]
+            self.apply_tiled(
+                partial(self._denoise, grayscale=is_gray), image,
+                merge_rects(selected, self.denoising_margin), self.denoising_margin, result)
+        return result
+
+    def apply_tiled(
+            self,
+            function: Callable[[MatLike], MatLike],
+            image: MatLike,
+            areas: list[tuple[int, int, int, int]],
+            margin: int,
+            out: MatLike) -> MatLike:
+        """
+        Apply a local image operation to areas of an image, tile by tile in parallel.
+
+        Args:
+            function: Operation whose output pixels only depend on the input
+                pixels at most `margin` pixels away
+            image: Input image
+            areas: Rectangles [x1, y1, x2, y2] of the image to process
+            margin: Width of the input around every tile
+            out: Image the results are written to, single channel results
+                are written to every channel
+
+        Returns:
+            MatLike: `out`
+        """
+        height, width = image.shape[:2]
+        tiles = [tile for area in areas for tile in split_rect(area, self.tile_size)]
+
+        def run(tile):
+            x1, y1, x2, y2 = tile
+            # Crop with the margin, clamped to the image like a single pass
+            cx1, cy1 = max(x1 - margin, 0), max(y1 - margin, 0)
+            cx2, cy2 = min(x2 + margin, width), min(y2 + margin, height)
+            return function(image[cy1:cy2, cx1:cx2])[y1 - cy1:y2 - cy1, x1 - cx1:x2 - cx1]
+
+        with ThreadPoolExecutor() as executor:
+            for (x1, y1, x2, y2), processed in zip(tiles, executor.map(run, tiles)):
+                if processed.ndim < out.ndim:
+                    processed = processed[..., None]
+                out[y1:y2, x1:x2] = processed
+        return out
+
+    def _denoise(self, image: MatLike, grayscale: bool = False) -> MatLike:
+        if grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if image.ndim == 2:
+            return cv2.fastNlMeansDenoising(
+                src=image,
+                h=self.config.filter_strength,
+                templateWindowSize=self.template_window_size,
+                searchWindowSize=self.search_window_size)
+        return cv2.fastNlMeansDenoisingColored(
+            src=image,
+            h=self.config.filter_strength,
+            templateWindowSize=self.template_window_size,
+            searchWindowSize=self.search_window_size)
+
+
+def merge_rects(rects: np.ndarray, margin: int = 0) -> list[tuple[int, int, int, int]]:
+    """
+    Merge rectangles whenever processing them together, each grown by
+    `margin`, covers no more pixels than processing them one by one.
+
+    Args:
+        rects: (N, 4) rectangles [x1, y1, x2, y2]
+        margin: Margin added around every rectangle when it is processed
+
+    Returns:
+        list: Rectangles [x1, y1, x2, y2] covering all the input rectangles
+    """
+    def cost(rect):
+        return (rect[2] - rect[0] + 2 * margin) * (rect[3] - rect[1] + 2 * margin)
+
+    merged = [tuple(rect) for rect in np.asarray(rects, dtype=int).reshape(-1, 4).tolist()]
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        for rect in merged:
+            for i, other in enumerate(result):
+                union = (
+                    min(rect[0], other[0]), min(rect[1], other[1]),
+                    max(rect[2], other[2]), max(rect[3], other[3]))
+                if cost(union) <= cost(rect) + cost(other):
+                    result[i] = union
+                    changed = True
+                    break
+            else:
+                result.append(rect)
+        merged = result
+    return merged
+
+
+def split_rect(rect: tuple[int, int, int, int], size: int) -> list[tuple[int, int, int, int]]:
+    """
+    Split a rectangle [x1, y1, x2, y2] into tiles of at most `size` x `size`.
+
+    The tiles of a side are all about the same size. A `size` of 0 keeps the
+    rectangle whole.
+    """
+    x1, y1, x2, y2 = rect
+    if size <= 0:
+        return [(x1, y1, x2, y2)]
+    xs = np.linspace(x1, x2, -(-(x2 - x1) // size) + 1).round().astype(int).tolist()
+    ys = np.linspace(y1, y2, -(-(y2 - y1) // size) + 1).round().astype(int).tolist()
+    return [
+        (tx1, ty1, tx2, ty2)
+        for ty1, ty2 in zip(ys[:-1], ys[1:])
+        for tx1, tx2 in zip(xs[:-1], xs[1:])
+    ]
@@ -1,34 +1,157 @@
+from typing import NamedTuple
+
 import cv2
 import numpy as np
 
+from ..template_validation import CompiledTemplate
+
 # type hinting
 from cv2.typing import MatLike
 Point = tuple[int, int]
 Corners = tuple[Point, Point, Point, Point]
 
 
+class MarkerLocations(NamedTuple):
+    # Marker ids in ascending order, (N,)
+    ids: np.ndarray
+    # Marker centers, (N, 2)
+    centers: np.ndarray
+    # Marker corners in clockwise order from the top-left, (N, 4, 2)
+    corners: np.ndarray
+
+    def as_dicts(self) -> tuple[dict[int, Point], dict[int, Corners]]:
+        centers: dict[int, Point] = {}
+        corners: dict[int, Corners] = {}
+        for id_, center, corners_ in zip(self.ids.tolist(), self.centers.tolist(), self.corners.tolist()):
+            centers[id_] = tuple(center)
+            corners[id_] = tuple(tuple(point) for point in corners_)
+        return centers, corners
+
+
 class ROIExtractor:
     def __init__(self, detector: cv2.aruco.ArucoDetector) -> None:
         self.arucodetector = detector
 
     def get_marker_locations(
             self,
-            image: MatLike
-            ) -> tuple[dict[int, Point], dict[int, Corners]]:
-        marker_corners, marker_ids, _ = self.arucodetector.detectMarkers(image)
-        centers: dict[int, Point] = {}
-        corners: dict[int, Corners] = {}
+            image: MatLike,
+            matrix: np.ndarray = None,
+            markers: dict[int, np.ndarray] = None,
+            marker_ids: set[int] | np.ndarray = None,
+            ) -> MarkerLocations:
+        """
+        Locate the markers in the aligned image.
+
+        If the perspective matrix and the markers already detected on the
+        scan are given, their corners are mapped onto the aligned image
+        instead of detecting the markers again. Detection on the aligned
+        image is then only done if any of `marker_ids` was missed.
+
+        Args:
+            image: Aligned image
+            matrix: Perspective matrix from the scan to the aligned image
+            markers: (4, 2) marker corners in scan coordinates, keyed by id
+            marker_ids: Ids of the markers that are needed
 
-        if marker_ids is None:
+        Returns:
+            MarkerLocations: Sorted marker ids with their centers and corners
+        """
+        ids = np.empty(0, dtype=int)
+        points = np.empty((0, 4, 2), dtype=np.float32)
+
+        if matrix is not None and markers:
+            ids, points = self._map_points(matrix, markers)
+            needed = np.array(list(marker_ids) if marker_ids is not None else [], dtype=int)
+            missing = np.setdiff1d(needed, ids)
+            if missing.size == 0:
+                return self._locations(ids, points)
+
+        marker_corners, marker_ids_, _ = self.arucodetector.detectMarkers(image)
+
+        if marker_ids_ is None:
+            if ids.size:
+                return self._locations(ids, points)
             raise ValueError('No markers found')
 
-        for id_, corners_ in zip(marker_ids.flatten(), marker_corners):
-            points = corners_.reshape((4, 2))
-            center = np.mean(points, axis=0).astype(int)
-            centers[id_] = tuple(center)
-            corners[id_] = tuple([tuple(x.astype(int)) for x in points])
+        # Only add the markers that were not mapped
+        detected_ids = marker_ids_.flatten().astype(int)
+        detected = np.float32(marker_corners).reshape(-1, 4, 2)
+        new = ~np.isin(detected_ids, ids)
+        ids = np.concatenate([ids, detected_ids[new]])
+        points = np.concatenate([points, detected[new]])
 
-        return centers, corners
+        return self._locations(ids, points)
+
+    def map_markers(
+            self,
+            matrix: np.ndarray,
+            markers: dict[int, np.ndarray],
+            ) -> MarkerLocations:
+        """
+        Map markers detected on the scan onto the aligned image.
+
+        Args:
+            matrix: Perspective matrix from the scan to the aligned image
+            markers: (4, 2) marker corners in scan coordinates, keyed by id
+
+        Returns:
+            MarkerLocations: Sorted marker ids with their centers and corners
+        """
+        if not markers:
+            return self._locations(np.empty(0, dtype=int), np.empty((0, 4, 2), dtype=np.float32))
+        return self._locations(*self._map_points(matrix, markers))
+
+    def regions_to_coordinates(
+            self,
+            template: CompiledTemplate,
+            locations: MarkerLocations,
+            ) -> np.ndarray:
+        """
+        Resolve the markers of every region to its rectangle at once.
+
+        Args:
+            template: Compiled template whose regions are located by markers
+            locations: Marker locations on the aligned image
+
+        Returns:
+            np.ndarray: (R, 4) rectangles [x1, y1, x2, y2], one per region
+
+        Raises:
+            ValueError: If a region uses a marker that was not found
+        """
+        # [x_left, x_right, y_top, y_bottom] marker ids per region
+        region_markers = template.markers
+
+        index = np.searchsorted(locations.ids, region_markers)
+        index = np.minimum(index, max(len(locations.ids) - 1, 0))
+        found = locations.ids[index] == region_markers if len(locations.ids) else np.zeros_like(region_markers, bool)
+        if not found.all():
+            missing = np.unique(region_markers[~found])
+            raise ValueError(f"Markers {' '.join(str(id_) for id_ in missing)} not found.")
+
+        xs = locations.centers[index[:, :2], 0]
+        ys = locations.centers[index[:, 2:], 1]
+
+        return np.stack([xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)], axis=1)
+
+    def _map_points(
+            self,
+            matrix: np.ndarray,
+            markers: dict[int, np.ndarray],
+            ) -> tuple[np.ndarray, np.ndarray]:
+        ids = np.fromiter(markers.keys(), dtype=int, count=len(markers))
+        points = np.float32(list(markers.values())).reshape(-1, 1, 2)
+        points = cv2.perspectiveTransform(points, matrix).reshape(-1, 4, 2)
+        return ids, points
+
+    def _locations(self, ids: np.ndarray, points: np.ndarray) -> MarkerLocations:
+        order = np.argsort(ids, kind='stable')
+        points = points[order]
+        return MarkerLocations(
+            ids=ids[order],
+            centers=points.mean(axis=1).astype(int),
+            corners=points.astype(int),
+        )
 
     def draw_markers(
             self,
@@ -78,13 +201,14 @@ class ROIExtractor:
             self,
             image: MatLike,
             locations: dict[int, tuple[int, int]],
-            x1_id: int, x2_id: int, y1_id: int, y2_id: int) -> MatLike:
+            x1_id: int, x2_id: int, y1_id: int, y2_id: int,
+            copy: bool = False) -> MatLike:
         x1 = locations[x1_id][0]
         x2 = locations[x2_id][0]
         y1 = locations[y1_id][1]
         y2 = locations[y2_id][1]
 
-        return image[y1:y2, x1:x2].copy()
+        return self.crop_roi_coordinates(image, x1, y1, x2, y2, copy)
 
     def draw_roi_coordinates(
             self,
@@ -102,17 +226,23 @@ class ROIExtractor:
     def crop_roi_coordinates(
             self,
             image: MatLike,
-            x1: int, y1: int, x2: int, y2: int):
-        return image[y1:y2, x1:x2].copy()
+            x1: int, y1: int, x2: int, y2: int,
+            copy: bool = False) -> MatLike:
+        """
+        Crop a region of the image.
+
+        The crop is a view of the image unless `copy` is set, so callers
+        that write into the crop must ask for a copy.
+        """
+        roi = image[y1:y2, x1:x2]
+        return roi.copy() if copy else roi
 
 
 def main():
     extractor = ROIExtractor()
 
     image = cv2.imread('./scanned/fiducial_test_6.png')
-    centers, corners = extractor.get_marker_locations(image)
-    centers = dict(sorted(centers.items()))
-    corners = dict(sorted(corners.items()))
+    centers, corners = extractor.get_marker_locations(image).as_dicts()
     for id_, coords in centers.items():
         print(f'{id_} : {coords}')
 
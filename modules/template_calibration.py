@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+
+from .checkbox_detection.checkbox_detector import CheckboxDetector
+from .homography_alignment.homography_aligner import HomographyAligner
+from .page_analysis.page_analysis import PageAnalysis
+from .roi_extraction.roi_extractor import ROIExtractor
+from .template_validation import CompiledTemplate, RegionType, REGION_TYPES
+
+
+def calibrate_template(
+        compiled: CompiledTemplate,
+        homography_aligner: HomographyAligner,
+        roi_extractor: ROIExtractor,
+        checkbox_detector: CheckboxDetector,
+        reference_dilation: int = 5,
+        ) -> CompiledTemplate:
+    """
+    Learn the blank form of a template from its reference image.
+
+    The `reference_image` of the template is aligned like any other scan.
+    The outline of every checkbox is searched once, so that pages only
+    need an ink ratio lookup per checkbox, and the printed ink of the form
+    is kept so that detectors can look at the ink added on a page only.
+
+    Args:
+        compiled: Compiled template
+        homography_aligner: Aligner of the scans
+        roi_extractor: Locator of the marker regions
+        checkbox_detector: Detector whose indents are applied
+        reference_dilation: Size of the square the printed ink is grown by
+            to absorb small alignment errors
+
+    Returns:
+        CompiledTemplate: The template with `inner_rects` and
+        `reference_ink`, unchanged if it has no reference image
+
+    Raises:
+        ValueError: If the reference image cannot be read or aligned
+    """
+    template = compiled.template
+    if not template.reference_image:
+        return compiled
+
+    image = cv2.imread(template.reference_image)
+    if image is None:
+        raise ValueError(f'Could not read reference image {template.reference_image}')
+
+    length = template.length
+    width = template.width
+
+    marker_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # The blank form goes through the same preprocessing as the scans
+    preprocessing = compiled.preprocessing
+    if preprocessing is not None:
+        marker_image = preprocessing.apply_homography_preprocessing(marker_image)
+    matrix, markers = homography_aligner.find_homography(
+        marker_image, length, width,
+        search_corners=template.use_coordinates and not template.marker_positions,
+        marker_positions=template.marker_positions,
+        marker_size=template.marker_size)
+    aligned = homography_aligner.warp(image, matrix, length, width)
+
+    if template.use_coordinates:
+        rects = compiled.rects
+    else:
+        locations = roi_extractor.get_marker_locations(aligned, matrix, markers, compiled.marker_ids)
+        rects = roi_extractor.regions_to_coordinates(compiled, locations)
+
+    if preprocessing is not None:
+        aligned = preprocessing.apply_data_extraction_preprocessing(
+            aligned, rects, compiled.types != REGION_TYPES.index(RegionType.TEXT))
+    page = PageAnalysis(aligned)
+
+    kernel = np.ones((reference_dilation, reference_dilation), np.uint8)
+    reference_ink = cv2.dilate(page.ink, kernel)
+
+    checkboxes = compiled.groups[RegionType.CHECKBOX]
+    if checkboxes.size == 0:
+        return compiled._replace(reference_ink=reference_ink)
+
+    inner_rects = np.zeros((len(compiled.names), 4), dtype=int)
+    inner_rects[checkboxes] = checkbox_detector.calibrate(page, rects[checkboxes])
+
+    return compiled._replace(inner_rects=inner_rects, reference_ink=reference_ink)
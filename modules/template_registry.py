@@ -0,0 +1,259 @@
+import os
+import threading
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+try:
+    # Optional, uses inotify on Linux
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+from .config import TEMPLATES_FOLDER
+from .template_validation import (
+    Template,
+    CompiledTemplate,
+    compile_template,
+    validate_template_file,
+)
+
+
+class TemplateEntry(NamedTuple):
+    # (mtime_ns, size) of the file when it was parsed
+    stamp: tuple[int, int]
+    # Display name, e.g. `02.yaml  |  "Type - Title"`
+    name: str
+    template: Template | None
+    compiled: CompiledTemplate | None
+    # Validation error of the current file, the last valid version is kept
+    error: str = ''
+    # Number of refreshes in a row the file was missing on
+    missing: int = 0
+
+
+class TemplateRegistry:
+    """
+    Parsed and compiled templates of a folder.
+
+    Files are only validated again when their modification time or size
+    changed since they were last parsed, so refreshing the registry costs
+    one `stat` per unchanged file. If a changed file fails validation, the
+    last valid version of the template is kept and the error is recorded.
+
+    `calibrate` is applied to every newly compiled template, e.g. to learn
+    the checkbox geometry from the blank form of the template.
+
+    A file that disappears, e.g. while an editor saves it by renaming a new
+    file over it, is kept until it is missing on `forget_after` refreshes
+    in a row or is unloaded with `unload`.
+
+    The entries are replaced as a whole on every refresh, so readers in
+    other threads always see a consistent set of templates.
+    """
+    def __init__(
+            self,
+            folder: str = TEMPLATES_FOLDER,
+            calibrate: Callable[[CompiledTemplate], CompiledTemplate] = None,
+            forget_after: int = 3,
+            ) -> None:
+        self.folder = folder
+        self.calibrate = calibrate
+        # Number of refreshes in a row a file must be missing on to be forgotten
+        self.forget_after = forget_after
+        # Entries keyed by file path, in discovery order
+        self.entries: dict[str, TemplateEntry] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher: threading.Thread | None = None
+        self._observer = None
+
+    def refresh(self) -> bool:
+        """
+        Parse the templates that were added or changed since the last refresh.
+
+        Files loaded with `load` from outside the folder are checked as well.
+
+        Returns:
+            bool: True if any template was added, changed or removed
+        """
+        with self._lock:
+            paths = [str(path) for path in sorted(Path(self.folder).rglob('*.yaml'))]
+            found = set(paths)
+            paths += [path for path in self.entries if path not in found]
+
+            entries: dict[str, TemplateEntry] = {}
+            changed = False
+
+            for path in paths:
+                entry = self._load(path)
+                if entry is None or entry.missing >= self.forget_after:
+                    continue
+                previous = self.entries.get(path)
+                changed |= previous is None or previous.compiled is not entry.compiled
+                entries[path] = entry
+
+            changed |= entries.keys() != self.entries.keys()
+            self.entries = entries
+            return changed
+
+    def load(self, path: str) -> CompiledTemplate:
+        """
+        Get the compiled template of a file, parsing it only if it changed.
+
+        Args:
+            path: Path to the YAML template file
+
+        Returns:
+            CompiledTemplate: Compiled template of the file
+
+        Raises:
+            ValueError: If the file is missing and was not loaded before,
+                or was never valid
+        """
+        path = str(Path(path))
+        with self._lock:
+            entry = self._load(path)
+            if entry is None:
+                raise ValueError(f'Template file not found: {path}')
+            self.entries = {**self.entries, path: entry}
+        if entry.compiled is None:
+            raise ValueError(entry.error)
+        return entry.compiled
+
+    def unload(self, path: str) -> None:
+        """Forget a template file, it is loaded again on the next refresh if it is in the folder."""
+        path = str(Path(path))
+        with self._lock:
+            self.entries = {key: entry for key, entry in self.entries.items() if key != path}
+
+    def get(self, path: str) -> CompiledTemplate:
+        """
+        Get the current compiled template of a loaded file without checking the file.
+
+        Raises:
+            ValueError: If the file was not loaded or was never valid
+        """
+        entry = self.entries.get(str(Path(path)))
+        if entry is None or entry.compiled is None:
+            raise ValueError(f'Template not loaded: {path}')
+        return entry.compiled
+
+    @property
+    def templates(self) -> dict[str, Template]:
+        """Valid templates keyed by display name"""
+        return {entry.name: entry.template for entry in self.entries.values() if entry.template is not None}
+
+    @property
+    def compiled(self) -> dict[str, CompiledTemplate]:
+        """Compiled valid templates keyed by display name"""
+        return {entry.name: entry.compiled for entry in self.entries.values() if entry.compiled is not None}
+
+    def watch(
+            self,
+            interval: float = 1.0,
+            on_change: Callable[['TemplateRegistry'], None] = None,
+            ) -> None:
+        """
+        Refresh the registry in the background whenever a template changes.
+
+        The folder is watched with watchdog if it is installed, otherwise it
+        is polled every `interval` seconds.
+
+        Args:
+            interval: Polling interval in seconds
+            on_change: Called from the watcher thread after templates changed
+        """
+        if self._watcher is not None or self._observer is not None:
+            return
+        self._stop.clear()
+
+        def refresh():
+            try:
+                changed = self.refresh()
+            except Exception as e:
+                print(f'Error reloading templates: {e}')
+                return
+            if changed and on_change is not None:
+                on_change(self)
+
+        if Observer is not None:
+            try:
+                self._observer = Observer()
+                handler = _TemplateEventHandler(refresh)
+                folders = {os.path.abspath(self.folder)}
+                folders |= {os.path.dirname(os.path.abspath(path)) for path in self.entries}
+                for folder in folders:
+                    if os.path.isdir(folder):
+                        self._observer.schedule(handler, folder, recursive=True)
+                self._observer.start()
+                return
+            except OSError:
+                # e.g. out of inotify watches, poll instead
+                self._observer = None
+
+        def poll():
+            while not self._stop.wait(interval):
+                refresh()
+
+        self._watcher = threading.Thread(target=poll, name='TemplateRegistry', daemon=True)
+        self._watcher.start()
+
+    def stop(self) -> None:
+        """Stop watching the templates."""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _load(self, path: str) -> TemplateEntry | None:
+        entry = self.entries.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if entry is None:
+                return None
+            # Keep the last version, the file may be in the middle of a save
+            return entry._replace(missing=entry.missing + 1)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        if entry is not None and entry.stamp == stamp:
+            return entry._replace(missing=0) if entry.missing else entry
+
+        filename = os.path.basename(path)
+        try:
+            template = validate_template_file(path)
+        except ValueError as e:
+            if entry is not None and entry.compiled is not None:
+                # Keep serving the last valid version until the file is fixed
+                print(f'Keeping the previous version of {path}: {e}')
+                return entry._replace(stamp=stamp, error=str(e))
+            # Skip the file if it is not a valid template
+            return TemplateEntry(stamp, filename, None, None, str(e))
+
+        compiled = compile_template(template)
+        if self.calibrate is not None:
+            try:
+                compiled = self.calibrate(compiled)
+            except Exception as e:
+                # The template still works without calibration
+                print(f'Could not calibrate {path}: {e}')
+
+        name = f'{filename}  |  \"{template.form_type} - {template.form_title}\"'
+        return TemplateEntry(stamp, name, template, compiled)
+
+
+class _TemplateEventHandler(FileSystemEventHandler):
+    def __init__(self, refresh: Callable[[], None]) -> None:
+        super().__init__()
+        self.refresh = refresh
+
+    def on_any_event(self, event) -> None:
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if any(str(path).endswith('.yaml') for path in paths):
+            self.refresh()
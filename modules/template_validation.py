@@ -1,8 +1,11 @@
 from pydantic import BaseModel, Field, field_validator
-from typing import List
+from typing import Dict, List, NamedTuple
 from enum import Enum
+import numpy as np
 import yaml
 
+from .preprocessing.preprocessing_pipeline import PreprocessingConfig, PreprocessingPipeline
+
 
 class RegionType(str, Enum):
     TEXT = 'text'
@@ -49,8 +52,108 @@ class Template(BaseModel):
     length: int = Field(..., gt=0)
     width: int = Field(..., gt=0)
     use_coordinates: bool = False
+    # Template side length of the corner markers, 0 if unknown
+    marker_size: float = Field(0, ge=0)
+    # Template [x, y] center of the other markers, or [x, y, size] for a
+    # marker whose size differs from `marker_size`
+    marker_positions: Dict[int, List[float]] = {}
+    # Scan of the blank form, used to calibrate the detectors
+    reference_image: str = ''
+    # Titles of the choice groups where several options may be marked
+    multi_choice: List[str] = []
+    # Preprocessing of the scans, none if not set
+    preprocessing: PreprocessingConfig | None = None
     regions: List[Region]
 
+    @field_validator('marker_positions')
+    def validate_marker_positions(cls, v):
+        """Validate marker positions are in [x, y] or [x, y, size] format"""
+        for id_, position in v.items():
+            if len(position) not in (2, 3):
+                raise ValueError(f'Position of marker {id_} must have 2 values [x, y] or 3 values [x, y, size]') # noqa
+            if len(position) == 3 and position[2] <= 0:
+                raise ValueError(f'Size of marker {id_} must be positive') # noqa
+        return v
+
+
+# Region type of every code in CompiledTemplate.types
+REGION_TYPES = tuple(RegionType)
+
+# Separates the group title from the option in region names, e.g. "Sex = Male"
+CHOICE_SEPARATOR = ' = '
+
+
+class CompiledTemplate(NamedTuple):
+    """Regions of a template packed into arrays for per-page processing"""
+    template: Template
+    # Region names, (R,)
+    names: tuple[str, ...]
+    # Region type codes, index into REGION_TYPES, (R,)
+    types: np.ndarray
+    # Region rectangles [x1, y1, x2, y2], only used with use_coordinates, (R, 4)
+    rects: np.ndarray
+    # Region marker ids [x_left, x_right, y_top, y_bottom], (R, 4)
+    markers: np.ndarray
+    # Ids of all the markers used by the regions in ascending order
+    marker_ids: np.ndarray
+    # Region indices of every region type
+    groups: dict[RegionType, np.ndarray]
+    # Region indices of the options of every "Title = Choice" group
+    choice_groups: dict[str, np.ndarray]
+    # Checkbox inner rectangles relative to the region top-left corner,
+    # learned from the blank reference form, (R, 4)
+    inner_rects: np.ndarray | None = None
+    # Printed ink of the aligned blank form, grown by a few pixels (1 for ink)
+    reference_ink: np.ndarray | None = None
+    # Preprocessing steps of the template, with their kernels created once
+    preprocessing: PreprocessingPipeline | None = None
+
+
+def compile_template(template: Template) -> CompiledTemplate:
+    """
+    Pack the regions of a template into arrays.
+
+    Compiling is done once per template so that pages are processed
+    without going through the region models again.
+
+    Args:
+        template: Template model
+
+    Returns:
+        CompiledTemplate: Region names, type codes, rectangles, markers,
+        choice groups and preprocessing steps
+    """
+    regions = template.regions
+    codes = {region_type.value: code for code, region_type in enumerate(REGION_TYPES)}
+
+    types = np.array([codes[region.type] for region in regions], dtype=np.uint8)
+    rects = np.array([region.coordinates for region in regions], dtype=int).reshape(-1, 4)
+    markers = np.array([region.markers for region in regions], dtype=int).reshape(-1, 4)
+
+    # Options of the same title and mark type form a choice group
+    options: dict[str, list[int]] = {}
+    for i, region in enumerate(regions):
+        title, separator, _ = region.name.partition(CHOICE_SEPARATOR)
+        if separator and region.type != RegionType.TEXT:
+            options.setdefault(title, []).append(i)
+    choice_groups = {
+        title: np.array(indices)
+        for title, indices in options.items()
+        if len(indices) > 1 and len(set(types[indices].tolist())) == 1
+    }
+
+    return CompiledTemplate(
+        template=template,
+        names=tuple(region.name for region in regions),
+        types=types,
+        rects=rects,
+        markers=markers,
+        marker_ids=np.unique(markers),
+        groups={region_type: np.flatnonzero(types == code) for code, region_type in enumerate(REGION_TYPES)},
+        choice_groups=choice_groups,
+        preprocessing=PreprocessingPipeline(template.preprocessing) if template.preprocessing is not None else None,
+    )
+
 
 def convert_template_to_dict(template: Template) -> dict:
     """
@@ -71,9 +174,22 @@ def convert_template_to_dict(template: Template) -> dict:
         'length': template.length,
         'width': template.width,
         'use_coordinates': template.use_coordinates,
-        'regions': []
     }
 
+    # Only written if set so existing templates stay unchanged
+    if template.marker_size:
+        result['marker_size'] = template.marker_size
+    if template.marker_positions:
+        result['marker_positions'] = template.marker_positions
+    if template.reference_image:
+        result['reference_image'] = template.reference_image
+    if template.multi_choice:
+        result['multi_choice'] = template.multi_choice
+    if template.preprocessing is not None:
+        result['preprocessing'] = template.preprocessing.model_dump()
+
+    result['regions'] = []
+
     for region in template.regions:
         if template.use_coordinates:
             result['regions'].append({
@@ -10,13 +10,27 @@ except ImportError:
     from .word_detector.word_detection import WordDetector
     from .parseq.word_recognition import WordRecognizer
 
+from ..page_analysis.page_analysis import PageAnalysis
+
 
 class TextRecognizer:
-    def __init__(self):
+    def __init__(self, blank_ratio: float = 0.001):
         self.word_detector = WordDetector()
         self.word_recognizer = WordRecognizer()
+        self.blank_ratio = blank_ratio
+
+    def recognize_text(
+            self,
+            image: np.ndarray,
+            page: PageAnalysis = None,
+            coordinates: list[int] = None) -> str:
+        # Skip empty fields, ignoring the form lines along the border
+        if page is not None and page.is_blank(
+                *coordinates,
+                inset=self.word_detector.border_px,
+                max_ratio=self.blank_ratio):
+            return ''
 
-    def recognize_text(self, image: np.ndarray) -> str:
         # Extract the word images
         bboxes = self.word_detector.extract_words(image)
 
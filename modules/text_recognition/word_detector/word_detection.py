@@ -61,9 +61,12 @@ def _clamp(value: int, min_value: int, max_value: int) -> int:
     return max(min(value, max_value), min_value)
 
 
+# Enables the debug visualization of the intermediate images
+DEBUG = False
+
+
 def show_image(image: np.ndarray, title: str = 'Image') -> None:
-    enabled = False
-    if not enabled:
+    if not DEBUG:
         return
     figure = plt.figure()
     ax = figure.add_subplot(1, 1, 1)
@@ -113,13 +116,14 @@ class WordDetector:
         assert image.dtype == np.uint8
 
         # Create a copy of the image for display purposes
-        disp_image = image.copy()
+        if DEBUG:
+            disp_image = image.copy()
 
         # Convert image to grayscale
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         show_image(image, 'Gray Image')
 
-        image_gray = image.copy()
+        image_gray = image
 
         # Threshold the image
         _, image = cv2.threshold(
@@ -200,20 +204,21 @@ class WordDetector:
             # pad the bounding box
             bbox = bbox.pad(self.padding_px)
             bbox = bbox.clamp(image.shape[1], image.shape[0])
-            cv2.rectangle(
-                disp_image,
-                bbox.top_left()-1, bbox.bottom_right()-1,
-                (0, 255, 0), 1)
             bboxes.append(bbox)
-            word_image = bbox.crop(image_gray)
-            # Compute the weighted centroid of the word image
-            a, b = _compute_weighted_centroid(word_image)
-            # Draw the centroid on the display image
-            disp_image[bbox.y + b, bbox.x + a] = [255, 0, 0]
-
-        show_image(disp_image, 'Detected Words')
-
-        plt.show()
+            if DEBUG:
+                cv2.rectangle(
+                    disp_image,
+                    bbox.top_left()-1, bbox.bottom_right()-1,
+                    (0, 255, 0), 1)
+                word_image = bbox.crop(image_gray)
+                # Compute the weighted centroid of the word image
+                a, b = _compute_weighted_centroid(word_image)
+                # Draw the centroid on the display image
+                disp_image[bbox.y + b, bbox.x + a] = [255, 0, 0]
+
+        if DEBUG:
+            show_image(disp_image, 'Detected Words')
+            plt.show()
 
         if bboxes:
             return sort_multiline(bboxes)
@@ -234,15 +239,17 @@ def _compute_weighted_centroid(image: np.ndarray) -> tuple[int, int]:
     assert image.ndim == 2
     assert image.dtype == np.uint8
 
-    # Compute the total sum of the image
-    total = np.sum(image)
+    # The raw moments weigh each pixel by its intensity, so m10 / m00 and
+    # m01 / m00 are the intensity-weighted x and y coordinates
+    moments = cv2.moments(image)
+    total = moments['m00']
 
-    # Compute the x and y coordinates of the weighted centroid
-    y, x = np.indices(image.shape)
-    a: np.float64 = np.sum(image * x) / total
-    b: np.float64 = np.sum(image * y) / total
+    # Fall back to the geometric center for an all-black image
+    if total == 0:
+        return image.shape[1] // 2, image.shape[0] // 2
 
-    a, b = int(a.round()), int(b.round())
+    a = int(round(moments['m10'] / total))
+    b = int(round(moments['m01'] / total))
 
     return a, b
 
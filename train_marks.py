@@ -0,0 +1,85 @@
+import os
+import json
+import argparse
+
+import cv2
+import numpy as np
+
+from batch import BatchRunner, MARK_TYPES, find_images
+from modules import MarkClassifier, RegionType
+from modules.config import DATA_FOLDER, MODELS_FOLDER
+
+
+def collect_marks(
+        runner: BatchRunner,
+        image_paths: list[str],
+        template_path: str,
+        data_folder: str = DATA_FOLDER,
+        ) -> dict[RegionType, tuple[list[np.ndarray], list[bool]]]:
+    """
+    Crop the mark regions of scans whose values were saved as JSON.
+
+    Every scan is matched with the JSON file of the same name in the data
+    folder, e.g. after the values were checked by hand, and aligned and
+    preprocessed like in the batch processing, so the classifiers are
+    trained on the same crops they classify.
+
+    Returns:
+        dict: Crops and values of the regions of every mark region type
+    """
+    compiled = runner.template_registry.load(template_path)
+    marks = {region_type: ([], []) for region_type in MARK_TYPES}
+
+    for image_path in image_paths:
+        filename = os.path.splitext(os.path.basename(image_path))[0]
+        data_path = os.path.join(data_folder, f'{filename}.json')
+        if not os.path.exists(data_path):
+            continue
+        with open(data_path) as file:
+            data = json.load(file)
+
+        image = cv2.imread(image_path)
+        if image is None:
+            print(f'Could not read image {image_path}, skipped')
+            continue
+        _, page, region_coordinates = runner.align_image(image, compiled)
+        if page is None:
+            print(f'{image_path} could not be aligned, skipped')
+            continue
+
+        for region_type, (crops, labels) in marks.items():
+            for i in compiled.groups[region_type].tolist():
+                value = data.get(compiled.names[i])
+                if isinstance(value, bool):
+                    crops.append(page.crop(*region_coordinates[i].tolist()))
+                    labels.append(value)
+
+    return marks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the mark classifiers from scans and their saved JSON files.')
+    parser.add_argument('images', nargs='+', help='Scanned images or folders of scanned images')
+    parser.add_argument('-t', '--template', required=True, help='Template YAML file of the scans')
+    parser.add_argument('-d', '--data', default=DATA_FOLDER, help='Folder of the JSON files of the scans')
+    parser.add_argument('-o', '--output', default=MODELS_FOLDER, help='Output folder of the models')
+    args = parser.parse_args()
+
+    runner = BatchRunner()
+    marks = collect_marks(runner, find_images(args.images), args.template, args.data)
+
+    os.makedirs(args.output, exist_ok=True)
+    for region_type, (crops, labels) in marks.items():
+        try:
+            classifier = MarkClassifier().fit(crops, labels)
+        except ValueError as e:
+            print(f'{region_type.value}: not trained, {e}')
+            continue
+        accuracy = np.mean(classifier.predict(crops) == np.asarray(labels))
+        save_path = os.path.join(args.output, f'{region_type.value}.npz')
+        classifier.save(save_path)
+        print(f'{region_type.value}: {len(labels)} regions, training accuracy {accuracy:.3f} -> {save_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,12 @@
 from __future__ import annotations
 import os
+from functools import partial
 
 import json
 import cv2
+import numpy as np
 import yaml
 from cv2.typing import MatLike
-from pathlib import Path
 from PyQt6.QtWidgets import (
     QMainWindow,
     QVBoxLayout,
@@ -25,6 +26,7 @@ from PyQt6.QtGui import (
     QPixmap,
     QImage,
 )
+from PyQt6 import sip
 from PyQt6.QtCore import (
     Qt,
     QPropertyAnimation,
@@ -35,12 +37,17 @@ from PyQt6.QtCore import (
 from modules import (
     ROIExtractor,
     HomographyAligner,
+    AlignmentQuality,
     CheckboxDetector,
     EncirclementDetector,
+    ChoiceResolver,
     TextRecognizer,
-    validate_template_file,
+    PageAnalysis,
     Template,
+    CompiledTemplate,
+    TemplateRegistry,
     RegionType,
+    calibrate_template,
 )
 from modules.config import (
     TEMPLATES_FOLDER,
@@ -59,7 +66,7 @@ from .BooleanComboBox import BooleanComboBox
 from .TextInput import TextInput
 from .Frame import Frame
 
-from modules.template_validation import Region, convert_template_to_dict
+from modules.template_validation import Region, REGION_TYPES, CHOICE_SEPARATOR, convert_template_to_dict
 
 
 class MainWindow(QMainWindow):
@@ -72,13 +79,22 @@ class MainWindow(QMainWindow):
         detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
 
         self.roi_extractor = ROIExtractor(detector)
-        self.homography_aligner = HomographyAligner(detector)
+        self.homography_aligner = HomographyAligner(detector, pyramid_levels=1, ransac_threshold=3.0)
         self.checkbox_detector = CheckboxDetector()
         self.encirclement_detector = EncirclementDetector()
         self.text_recognizer = TextRecognizer()
+        self.choice_resolver = ChoiceResolver(self.checkbox_detector, self.encirclement_detector)
 
         self.datafields: dict[str, BooleanComboBox | TextInput] = {}
+        self.alignment_quality: AlignmentQuality = None
+        # Templates are calibrated on their blank form
+        self.template_registry = TemplateRegistry(TEMPLATES_FOLDER, calibrate=partial(
+            calibrate_template,
+            homography_aligner=self.homography_aligner,
+            roi_extractor=self.roi_extractor,
+            checkbox_detector=self.checkbox_detector))
         self.templates: dict[str, Template] = {}
+        self.compiled_templates: dict[str, CompiledTemplate] = {}
 
         self.load_templates()
         self.current_image_path = ''
@@ -186,11 +202,19 @@ class MainWindow(QMainWindow):
             ErrorDialog()
 
     def process_image(self, image_path, selected):
+        previous_template = self.selected_template
         self.reset_datafields()
+        template = self.templates[selected]
+
+        # Show the preprocessing settings saved with a newly selected
+        # template, edits are kept when the same template is reloaded
+        if selected != previous_template and template.preprocessing is not None:
+            self.preprocessing_widget.set_config(template.preprocessing)
+
         self.current_image_path = image_path
         self.selected_template = selected
 
-        template = self.templates[selected]
+        compiled = self.compiled_templates[selected]
         regions = template.regions
 
         # Create progress dialog
@@ -220,16 +244,48 @@ class MainWindow(QMainWindow):
             marker_image = image.copy()
             marker_image = cv2.cvtColor(marker_image, cv2.COLOR_BGR2GRAY)
             marker_image = self.preprocessing_widget.apply_homography_preprocessing(marker_image)
-            image = self.homography_aligner.align(image, marker_image, length, width)
+            # Templates located by markers or aligned with every marker need
+            # all the markers on the page, the others only the corner markers
+            matrix, markers = self.homography_aligner.find_homography(
+                marker_image, length, width,
+                key=selected,
+                search_corners=template.use_coordinates and not template.marker_positions,
+                marker_positions=template.marker_positions,
+                marker_size=template.marker_size)
+            self.alignment_quality = self.homography_aligner.assess(
+                matrix, markers, length, width,
+                marker_positions=template.marker_positions,
+                marker_size=template.marker_size)
+            image = self.homography_aligner.warp(image, matrix, length, width)
         except Exception:
             progress.close()
             ErrorDialog()
             return
 
-        # Preprocess the image
+        if template.use_coordinates:
+            region_coordinates = compiled.rects.tolist()
+        else:
+            try:
+                # Reuse the markers detected during alignment
+                locations = self.roi_extractor.get_marker_locations(
+                    image, matrix, markers, compiled.marker_ids)
+                for corner in locations.corners:
+                    ((x1, y1), _, (x2, y2), _) = corner
+                    # TODO: Add the marker to the image
+                    # self.add_rect(x1, y1, x2, y2)
+                region_coordinates = self.roi_extractor.regions_to_coordinates(
+                    compiled, locations).tolist()
+            except Exception:
+                progress.close()
+                ErrorDialog()
+                return
+
+        # Preprocess the image, only the regions are denoised and the
+        # checkboxes and encirclements are only read in grayscale
         try:
             progress.setLabelText("Preprocessing image...")
-            image = self.preprocessing_widget.apply_data_extraction_preprocessing(image)
+            image = self.preprocessing_widget.apply_data_extraction_preprocessing(
+                image, region_coordinates, compiled.types != REGION_TYPES.index(RegionType.TEXT))
         except Exception:
             progress.close()
             ErrorDialog()
@@ -239,22 +295,13 @@ class MainWindow(QMainWindow):
         self.photo_viewer.viewer.set_photo(pixmap)
         progress.setValue(2)
 
+        # Binarize the page once for all the region detectors, pen marks
+        # are told apart from the print if the template has a blank form
+        page = PageAnalysis(image, compiled.reference_ink)
+
         if progress.wasCanceled():
             return
 
-        centers = {}
-        if not template.use_coordinates:
-            try:
-                centers, corners = self.roi_extractor.get_marker_locations(image)
-                for _, corner in corners.items():
-                    ((x1, y1), _, (x2, y2), _) = corner
-                    # TODO: Add the marker to the image
-                    # self.add_rect(x1, y1, x2, y2)
-            except Exception:
-                progress.close()
-                ErrorDialog()
-                return
-
         # Load the text recognition model
         progress.setLabelText("Loading the text recognition model...")
         self.text_recognizer.word_recognizer.load_model()
@@ -263,10 +310,33 @@ class MainWindow(QMainWindow):
         if progress.wasCanceled():
             return
 
+        # The options of a choice group are decided together
+        chosen: dict[int, bool] = {}
+        for title, indices in compiled.choice_groups.items():
+            result = self.choice_resolver.resolve_group(
+                page,
+                [compiled.names[j].partition(CHOICE_SEPARATOR)[2] for j in indices.tolist()],
+                np.array(region_coordinates, dtype=int).reshape(-1, 4)[indices],
+                REGION_TYPES[compiled.types[indices[0]]],
+                None if compiled.inner_rects is None else compiled.inner_rects[indices],
+                multiple=title in template.multi_choice)
+            chosen.update(zip(indices.tolist(), result.marked.tolist()))
+
+        # Detect all the other checkboxes of the page at once
+        checkbox_indices = compiled.groups[RegionType.CHECKBOX]
+        checkbox_indices = checkbox_indices[~np.isin(checkbox_indices, list(chosen))]
+        checkbox_rects = np.array(region_coordinates, dtype=int).reshape(-1, 4)[checkbox_indices]
+        inner_rects = None if compiled.inner_rects is None else compiled.inner_rects[checkbox_indices]
+        checked = dict(zip(
+            checkbox_indices.tolist(),
+            self.checkbox_detector.detect_many(page, checkbox_rects, inner_rects).tolist()))
+
         # Process each region in the template
+        region_types = compiled.types.tolist()
         for i, region in enumerate(regions):
             progress.setLabelText(f"Processing region: {i + 1}/{len(regions)}")
-            coordinates = region.coordinates if template.use_coordinates else markers_to_coordinates(region.markers, centers)
+            coordinates = region_coordinates[i]
+            region_type = REGION_TYPES[region_types[i]]
 
             # Draw the ROI and add it to the photo viewer
             x1, y1, x2, y2 = coordinates
@@ -276,8 +346,9 @@ class MainWindow(QMainWindow):
             self.create_region(region_box, region, template.use_coordinates, False)
 
             # Crop the ROI
+            # Views of the page, the detectors do not write into them
             cropped_region = self.roi_extractor.crop_roi_coordinates(image, *coordinates)
-            gray_region = cv2.cvtColor(cropped_region, cv2.COLOR_BGR2GRAY)
+            gray_region = page.gray_roi(*coordinates)
 
             # Define the data groupbox first so the rect_item can scroll to it
             groupbox = Frame()
@@ -299,25 +370,30 @@ class MainWindow(QMainWindow):
             groupbox_layout.addWidget(value_label)
             field_widget = None
 
-            if region.type == RegionType.ENCIRCLEMENT:
+            if region_type == RegionType.ENCIRCLEMENT:
 
                 field_widget = BooleanComboBox()
                 groupbox_layout.addWidget(field_widget)
-                has_circle = self.encirclement_detector.detect(gray_region)
+                if i in chosen:
+                    has_circle = chosen[i]
+                else:
+                    has_circle = self.encirclement_detector.detect(
+                        gray_region, page=page, coordinates=coordinates)
                 field_widget.setCurrentIndex(0 if has_circle else 1)
 
-            elif region.type == RegionType.CHECKBOX:
+            elif region_type == RegionType.CHECKBOX:
 
                 field_widget = BooleanComboBox()
                 groupbox_layout.addWidget(field_widget)
-                is_checked = self.checkbox_detector.detect(gray_region)
+                is_checked = chosen[i] if i in chosen else checked[i]
                 field_widget.setCurrentIndex(0 if is_checked else 1)
 
-            elif region.type == RegionType.TEXT:
+            elif region_type == RegionType.TEXT:
 
                 field_widget = TextInput()
                 groupbox_layout.addWidget(field_widget)
-                text = self.text_recognizer.recognize_text(cropped_region)
+                text = self.text_recognizer.recognize_text(
+                    cropped_region, page=page, coordinates=coordinates)
                 field_widget.setText(text)
 
             else:
@@ -367,6 +443,9 @@ class MainWindow(QMainWindow):
             else:
                 print(f'Unhandled widget type for region_name: {region_name}')
 
+        if self.alignment_quality is not None:
+            data['_alignment'] = self.alignment_quality._asdict()
+
         base_name = os.path.basename(self.current_image_path)
         filename = os.path.splitext(base_name)[0]
         default_save_name = f"{filename}.json"
@@ -388,6 +467,7 @@ class MainWindow(QMainWindow):
 
     def reset_datafields(self):
         self.datafields.clear()
+        self.alignment_quality = None
         self.photo_viewer.viewer.set_photo(None)
         self.clear_layout(self.data_widget_layout)
         self.current_image_path = ''
@@ -544,28 +624,15 @@ class MainWindow(QMainWindow):
         return callback
 
     def load_templates(self):
-        self.templates.clear()
-
         try:
-            # Get all YAML files in the template folder
-            template_files = Path(TEMPLATES_FOLDER).rglob('*.yaml')
-
-            for template_file in template_files:
-                try:
-                    # Validate the template
-                    template = validate_template_file(template_file)
-                    # Get the filename
-                    filename = os.path.basename(template_file)
-
-                    # Add the template to the dictionary
-                    name = f'{filename}  |  \"{template.form_type} - {template.form_title}\"'
-                    self.templates[name] = template
-                except Exception:
-                    # Skip the file if it is not a valid template
-                    continue
+            # Only the templates that changed since the last load are parsed
+            self.template_registry.refresh()
         except Exception:
             ErrorDialog()
 
+        self.templates = self.template_registry.templates
+        self.compiled_templates = self.template_registry.compiled
+
     def save_template(self):
         current_dir = os.getcwd()
         dir_path = os.path.join(current_dir, TEMPLATES_FOLDER)
@@ -588,7 +655,18 @@ class MainWindow(QMainWindow):
         if not file_path:
             return
 
-        template_dict = convert_template_to_dict(self.template_ui.value())
+        template = self.template_ui.value()
+
+        # Keep the settings that are not edited in the template view
+        source = self.templates.get(self.selected_template)
+        if source is not None:
+            template.marker_size = source.marker_size
+            template.marker_positions = source.marker_positions
+            template.reference_image = source.reference_image
+            template.multi_choice = source.multi_choice
+        template.preprocessing = self.preprocessing_widget.config()
+
+        template_dict = convert_template_to_dict(template)
 
         with open(file_path, 'w') as file:
             yaml.dump(template_dict, file, sort_keys=False)
@@ -599,46 +677,20 @@ class MainWindow(QMainWindow):
                 self.photo_viewer.viewer._scene.removeItem(item)
 
 
-type Point = tuple[int, int]
-
-
-def markers_to_coordinates(
-        markers: list[int],
-        centers: dict[int, Point]
-        ) -> list[int]:
-
-    assert len(markers) == 4
-    x1_id, x2_id, y1_id, y2_id = markers
-
-    a = centers[x1_id][0]
-    h = centers[x2_id][0]
-    b = centers[y1_id][1]
-    k = centers[y2_id][1]
-
-    return [
-        min(a, h),
-        min(b, k),
-        max(a, h),
-        max(b, k),
-    ]
-
-
 def create_image(image: MatLike) -> QImage:
+    # Region views keep the row stride of the page, which QImage takes as
+    # is, so only images whose pixels are not packed within a row are copied
+    pixel_size = image.shape[2] if image.ndim == 3 else 1
+    if image.strides[0] <= 0 or image.strides[-1] != 1 or (image.ndim == 3 and image.strides[1] != pixel_size):
+        image = np.ascontiguousarray(image)
+    height, width = image.shape[:2]
     if len(image.shape) == 2:
         # Grayscale image
-        height, width = image.shape
-        bytes_per_line = width
-        return QImage(
-            image.data,
-            width, height, bytes_per_line,
-            QImage.Format.Format_Grayscale8
-        )
+        image_format = QImage.Format.Format_Grayscale8
     else:
         # Color image (BGR)
-        height, width, channel = image.shape
-        bytes_per_line = channel * width
-        return QImage(
-            image.data,
-            width, height, bytes_per_line,
-            QImage.Format.Format_BGR888
-        )
+        image_format = QImage.Format.Format_BGR888
+    qimage = QImage(sip.voidptr(image.ctypes.data), width, height, image.strides[0], image_format)
+    # The QImage does not own its buffer, keep it alive as long as the QImage
+    qimage.buffer = image
+    return qimage
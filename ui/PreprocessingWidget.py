@@ -9,7 +9,13 @@ from PyQt6.QtWidgets import (
 from PyQt6.QtCore import (
     Qt,
 )
-import cv2
+import numpy as np
+
+from modules.preprocessing.preprocessing_pipeline import (
+    KERNEL_SHAPES,
+    PreprocessingConfig,
+    PreprocessingPipeline,
+)
 
 from .utils import MatLike
 
@@ -27,6 +33,8 @@ class PreprocessingWidget(QWidget):
         super().__init__(parent)
         self.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
 
+        self._pipeline: PreprocessingPipeline | None = None
+
         self.init_ui()
 
     def init_ui(self):
@@ -69,7 +77,7 @@ class PreprocessingWidget(QWidget):
         frame_layout.addLayout(form_layout)
 
         self.kernel_shape = Dropdown(
-            options=['Rectangular', 'Elliptical', 'Cross-shaped'],
+            options=list(KERNEL_SHAPES),
             current_index=0,
             width=150,
         )
@@ -237,72 +245,57 @@ class PreprocessingWidget(QWidget):
 
         layout.addStretch(1)
 
-    def apply_data_extraction_preprocessing(self, image: MatLike) -> MatLike:
-
-        image = image.copy()
-
-        # Denoising (Fast Non-Local Means Denoising)
-        # ------------------------
-
-        if self.enable_denoising.isChecked():
-            h = self.filter_strength.value()
-            template_window_size = self.template_window_size.value()
-            template_window_size = template_window_size if template_window_size % 2 == 1 else template_window_size + 1
-            search_window_size = self.search_window_size.value()
-            search_window_size = search_window_size if search_window_size % 2 == 1 else search_window_size + 1
-            image = cv2.fastNlMeansDenoisingColored(
-                src=image,
-                h=h,
-                templateWindowSize=template_window_size,
-                searchWindowSize=search_window_size)
-
-        # Contrast Enhancement (CLAHE)
-        # ------------------------
-
-        if self.enable_clahe.isChecked():
-            clip_limit = self.clip_limit.value()
-            tile_grid_size = (self.tile_grid_size_x.value(), self.tile_grid_size_y.value())
-
-            clahe = cv2.createCLAHE(
-                clipLimit=clip_limit,
-                tileGridSize=tile_grid_size)
-
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            image = clahe.apply(image)
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    def config(self) -> PreprocessingConfig:
+        """Preprocessing settings currently entered in the widget"""
+        return PreprocessingConfig(
+            fiducial_enhancement=self.enable_fiducial_enhancement.isChecked(),
+            kernel_shape=self.kernel_shape.currentText(),
+            kernel_size=[self.kernel_size_x.value(), self.kernel_size_y.value()],
+            iterations=self.iterations.value(),
+            brightness_contrast=self.enable_brightness_contrast.isChecked(),
+            alpha=self.alpha.value(),
+            beta=self.beta.value(),
+            denoising=self.enable_denoising.isChecked(),
+            filter_strength=self.filter_strength.value(),
+            template_window_size=self.template_window_size.value(),
+            search_window_size=self.search_window_size.value(),
+            clahe=self.enable_clahe.isChecked(),
+            clip_limit=self.clip_limit.value(),
+            tile_grid_size=[self.tile_grid_size_x.value(), self.tile_grid_size_y.value()],
+        )
 
-        return image
+    def set_config(self, config: PreprocessingConfig):
+        """Show the preprocessing settings of a template in the widget"""
+        self.enable_fiducial_enhancement.setChecked(config.fiducial_enhancement)
+        self.kernel_shape.setCurrentText(config.kernel_shape)
+        self.kernel_size_x.setValue(config.kernel_size[0])
+        self.kernel_size_y.setValue(config.kernel_size[1])
+        self.iterations.setValue(config.iterations)
+        self.enable_brightness_contrast.setChecked(config.brightness_contrast)
+        self.alpha.setValue(config.alpha)
+        self.beta.setValue(config.beta)
+        self.enable_denoising.setChecked(config.denoising)
+        self.filter_strength.setValue(config.filter_strength)
+        self.template_window_size.setValue(config.template_window_size)
+        self.search_window_size.setValue(config.search_window_size)
+        self.enable_clahe.setChecked(config.clahe)
+        self.clip_limit.setValue(config.clip_limit)
+        self.tile_grid_size_x.setValue(config.tile_grid_size[0])
+        self.tile_grid_size_y.setValue(config.tile_grid_size[1])
+
+    def pipeline(self) -> PreprocessingPipeline:
+        """Pipeline of the current settings, only rebuilt when they change"""
+        config = self.config()
+        if self._pipeline is None or self._pipeline.config != config:
+            self._pipeline = PreprocessingPipeline(config)
+        return self._pipeline
+
+    def apply_data_extraction_preprocessing(
+            self,
+            image: MatLike,
+            rects: np.ndarray = None,
+            grayscale: np.ndarray = None) -> MatLike:
+        return self.pipeline().apply_data_extraction_preprocessing(image, rects, grayscale)
 
     def apply_homography_preprocessing(self, image: MatLike) -> MatLike:
-
-        image = image.copy()
-
-        # Morphological Closing
-        # ------------------------
-        if self.enable_fiducial_enhancement.isChecked():
-            match self.kernel_shape.currentText():
-                case 'Rectangular':
-                    kernel_shape = cv2.MORPH_RECT
-                case 'Elliptical':
-                    kernel_shape = cv2.MORPH_ELLIPSE
-                case 'Cross-shaped':
-                    kernel_shape = cv2.MORPH_CROSS
-                case _:
-                    kernel_shape = cv2.MORPH_RECT
-            kernel_size = (self.kernel_size_x.value(), self.kernel_size_y.value())
-            iterations = self.iterations.value()
-
-            structuring_element = cv2.getStructuringElement(
-                shape=kernel_shape,
-                ksize=kernel_size)
-            image = cv2.morphologyEx(
-                src=image, op=cv2.MORPH_CLOSE, kernel=structuring_element, iterations=iterations)
-
-        # Brightness and Contrast
-        # ------------------------
-        if self.enable_brightness_contrast.isChecked():
-            alpha = self.alpha.value()
-            beta = self.beta.value()
-            image = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-
-        return image
+        return self.pipeline().apply_homography_preprocessing(image)